@@ -3,28 +3,28 @@ import streamlit as st
 from utils import initialize_session_state_variables, set_need_appearances_writer
 from pages import Pages
 from auth import Authenticator
-from gservices import GServices
+from gservices import get_service
 from loader import Loader
 import config
-from db import create_db, User
+from db import session_scope, User
 from comps import add_boostrap, navbar
+import metrics
 
 
 st.set_page_config(page_title="Language Hour Entry", page_icon="🌐", layout="wide")
 session_variables = config.SESSION_VARS
 initialize_session_state_variables(session_variables)
-st.session_state.req_count = 0
 
 
 if __name__ == '__main__':
     #add_boostrap()
-    #db = create_db()
-    service = GServices(config.SERVICE_ACCOUNT, config.SCOPES)
+    #with session_scope() as db:
+    #    user = db.query(User).all()[0]
+    service = get_service()
     st.session_state.service = service
     auth = Authenticator(service)
     pages = Pages()
 
-    #user = db.query(User).all()[0]
 #
     #login = comps.login()
     #entry_form = comps.form('Language Hour Entry', user=user)
@@ -37,13 +37,13 @@ if __name__ == '__main__':
     if st.session_state.authenticated:
         with st.spinner('loading application...'):
             if not st.session_state.loaded:
-                loader = Loader(
+                st.session_state.loader = Loader(
                     st.session_state.service,
                     st.session_state.current_user,
                     st.session_state.current_user['Group']
                 )
                 try:
-                    loader.load_data()
+                    st.session_state.loader.load_data()
                     st.session_state.loaded = True
                 except:
                     st.error('error')
@@ -65,6 +65,7 @@ if __name__ == '__main__':
             try:
                 pages.dev_sidebar()
                 pages.dev_page()
+                metrics.render(metrics.get_metrics())
             except Exception as e:
                 st.error('error')
     else:
@@ -0,0 +1,375 @@
+'''in-memory stand-in for the sheets and drive endpoints GServices uses
+
+FakeGoogle holds the spreadsheets and drive files, FakeHttp answers requests against it the
+way httplib2.Http would, optionally after a fixed latency. pass fake.http as the
+http_factory of GServices to run the app without credentials or network access.
+'''
+import email.parser
+import itertools
+import json
+import re
+import threading
+import uuid
+from datetime import datetime, timezone
+from time import sleep
+from urllib.parse import parse_qs, unquote, urlsplit
+import httplib2
+
+
+def column_index(letters):
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def parse_cell(cell):
+    '''"B3" -> (col 1, row 2), missing parts are None'''
+    match = re.fullmatch(r'([A-Za-z]*)(\d*)', cell)
+    letters, digits = match.groups()
+    return (column_index(letters) if letters else None, int(digits) - 1 if digits else None)
+
+
+def parse_range(a1):
+    '''"Tab!A2:K" -> (tab, first row, last row, first col, last col), open ends are None'''
+    tab, _, cells = a1.rpartition('!')
+    if not tab:
+        tab, cells = cells, ''
+    if tab.startswith("'") and tab.endswith("'"):
+        tab = tab[1:-1].replace("''", "'")
+    start, _, end = cells.partition(':')
+    start_col, start_row = parse_cell(start) if start else (None, None)
+    end_col, end_row = parse_cell(end) if end else (start_col, start_row) if not _ else (None, None)
+    return tab, start_row or 0, end_row, start_col or 0, end_col
+
+
+class FakeError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class FakeGoogle:
+    '''spreadsheets as lists of rows per tab, drive files as metadata dicts'''
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.spreadsheets = {}
+        self.sheet_ids = {}
+        self.files = {}
+        self.uploads = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.RLock()
+
+    def http(self):
+        return FakeHttp(self)
+
+    # setup helpers
+
+    def add_spreadsheet(self, spreadsheet_id, tabs):
+        '''tabs maps tab name to a list of rows, the first row being the header'''
+        with self.lock:
+            self.spreadsheets[spreadsheet_id] = {}
+            self.sheet_ids[spreadsheet_id] = {}
+            for title, rows in tabs.items():
+                self.add_tab(spreadsheet_id, title, rows)
+            self.add_file(spreadsheet_id, spreadsheet_id, 'application/vnd.google-apps.spreadsheet', [])
+
+    def add_tab(self, spreadsheet_id, title, rows=()):
+        self.spreadsheets[spreadsheet_id][title] = [[str(value) for value in row] for row in rows]
+        self.sheet_ids[spreadsheet_id][title] = next(self.ids)
+        self.touch(spreadsheet_id)
+
+    def add_file(self, file_id, name, mime_type, parents, content=b''):
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        with self.lock:
+            self.files[file_id] = {
+                'id': file_id,
+                'name': name,
+                'mimeType': mime_type,
+                'parents': list(parents),
+                'createdTime': now,
+                'modifiedTime': now,
+                'version': '1',
+                'trashed': False,
+                'content': content,
+            }
+        return self.files[file_id]
+
+    def touch(self, spreadsheet_id):
+        file = self.files.get(spreadsheet_id)
+        if file is not None:
+            file['modifiedTime'] = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            file['version'] = str(int(file['version']) + 1)
+
+    def new_id(self):
+        return uuid.uuid4().hex
+
+    # sheets
+
+    def tab(self, spreadsheet_id, title):
+        try:
+            return self.spreadsheets[spreadsheet_id][title]
+        except KeyError:
+            raise FakeError(400, f'Unable to parse range: {title}')
+
+    def read(self, spreadsheet_id, a1):
+        title, row0, row1, col0, col1 = parse_range(a1)
+        rows = self.tab(spreadsheet_id, title)
+        values = []
+        for row in rows[row0:None if row1 is None else row1 + 1]:
+            row = row[col0:None if col1 is None else col1 + 1]
+            while row and row[-1] == '':
+                row = row[:-1]
+            values.append(row)
+        while values and not values[-1]:
+            values.pop()
+        result = {'range': a1, 'majorDimension': 'ROWS'}
+        if values:
+            result['values'] = values
+        return result
+
+    def write(self, spreadsheet_id, a1, values):
+        title, row0, _, col0, _ = parse_range(a1)
+        rows = self.tab(spreadsheet_id, title)
+        for r, row in enumerate(values, start=row0):
+            while len(rows) <= r:
+                rows.append([])
+            target = rows[r]
+            while len(target) < col0 + len(row):
+                target.append('')
+            for c, value in enumerate(row, start=col0):
+                target[c] = '' if value is None else str(value)
+        self.touch(spreadsheet_id)
+        return {'updatedRange': a1, 'updatedRows': len(values)}
+
+    def append(self, spreadsheet_id, a1, values):
+        title, _, _, col0, _ = parse_range(a1)
+        rows = self.tab(spreadsheet_id, title)
+        last = len(rows)
+        while last and not any(rows[last - 1]):
+            last -= 1
+        start = f"'{title}'!{chr(ord('A') + col0)}{last + 1}"
+        return {'updates': self.write(spreadsheet_id, start, values)}
+
+    def batch_update(self, spreadsheet_id, requests):
+        replies = []
+        tabs = self.spreadsheets[spreadsheet_id]
+        ids = self.sheet_ids[spreadsheet_id]
+        titles = {sheet_id: title for title, sheet_id in ids.items()}
+        for request in requests:
+            if 'addSheet' in request:
+                title = request['addSheet']['properties']['title']
+                if title in tabs:
+                    raise FakeError(400, f'A sheet with the name "{title}" already exists.')
+                self.add_tab(spreadsheet_id, title)
+                replies.append({'addSheet': {'properties': {'sheetId': ids[title], 'title': title}}})
+            elif 'deleteSheet' in request:
+                title = titles.get(request['deleteSheet']['sheetId'])
+                if title is None:
+                    raise FakeError(400, 'No grid with id')
+                del tabs[title], ids[title]
+                replies.append({})
+            elif 'deleteDimension' in request:
+                dimension = request['deleteDimension']['range']
+                rows = tabs[titles[dimension['sheetId']]]
+                del rows[dimension['startIndex']:dimension['endIndex']]
+                replies.append({})
+            else:
+                replies.append({})
+        self.touch(spreadsheet_id)
+        return {'spreadsheetId': spreadsheet_id, 'replies': replies}
+
+    def sheets(self, method, path, query, body):
+        '''path is still percent-encoded, so a colon in it marks a custom method and not a range'''
+        match = re.fullmatch(r'/v4/spreadsheets/([^/:]+)(.*)', path)
+        spreadsheet_id, rest = match.groups()
+        if spreadsheet_id not in self.spreadsheets:
+            raise FakeError(404, 'Requested entity was not found.')
+        if rest == '' and method == 'GET':
+            return {
+                'spreadsheetId': spreadsheet_id,
+                'sheets': [
+                    {'properties': {'sheetId': sheet_id, 'title': title, 'index': i}}
+                    for i, (title, sheet_id) in enumerate(self.sheet_ids[spreadsheet_id].items())
+                ],
+            }
+        if rest == ':batchUpdate':
+            return self.batch_update(spreadsheet_id, body.get('requests', []))
+        if rest == '/values:batchGet':
+            return {
+                'spreadsheetId': spreadsheet_id,
+                'valueRanges': [self.read(spreadsheet_id, a1) for a1 in query.get('ranges', [])],
+            }
+        if rest == '/values:batchUpdate':
+            for data in body.get('data', []):
+                self.write(spreadsheet_id, data['range'], data['values'])
+            return {'spreadsheetId': spreadsheet_id, 'totalUpdatedRows': len(body.get('data', []))}
+        match = re.fullmatch(r'/values/([^:]+)(:append)?', rest)
+        if match:
+            a1 = unquote(match.group(1))
+            if match.group(2):
+                return self.append(spreadsheet_id, a1, body['values'])
+            if method == 'PUT':
+                return self.write(spreadsheet_id, a1, body['values'])
+            return self.read(spreadsheet_id, a1)
+        raise FakeError(404, f'unknown sheets call {method} {path}')
+
+    # drive
+
+    def matches(self, file, q):
+        for clause in re.split(r'\s+and\s+', q.strip()):
+            clause = clause.strip()
+            if match := re.fullmatch(r'''["'](.+)["']\s+in\s+parents''', clause):
+                if match.group(1) not in file['parents']:
+                    return False
+            elif match := re.fullmatch(r'''parents\s*=\s*["'](.+)["']''', clause):
+                if match.group(1) not in file['parents']:
+                    return False
+            elif match := re.fullmatch(r'''(\w+)\s*(=|>|<)\s*["']?([^"']*)["']?''', clause):
+                field, op, value = match.groups()
+                actual = str(file.get(field, '')).lower() if field == 'trashed' else str(file.get(field, ''))
+                if op == '=' and actual != value:
+                    return False
+                if op == '>' and not actual > value:
+                    return False
+                if op == '<' and not actual < value:
+                    return False
+        return True
+
+    def metadata(self, file):
+        return {key: value for key, value in file.items() if key != 'content'}
+
+    def drive(self, method, path, query, body, headers):
+        if path == '/drive/v3/files' and method == 'GET':
+            q = query.get('q', [''])[0]
+            files = [self.metadata(f) for f in self.files.values() if self.matches(f, q)]
+            start = int(query.get('pageToken', ['0'])[0])
+            size = int(query.get('pageSize', ['100'])[0])
+            page = {'files': files[start:start + size]}
+            if start + size < len(files):
+                page['nextPageToken'] = str(start + size)
+            return page
+        if path == '/drive/v3/files' and method == 'POST':
+            file = self.add_file(self.new_id(), body['name'], body.get('mimeType', ''), body.get('parents', []))
+            return self.metadata(file)
+        if path == '/upload/drive/v3/files' and method == 'POST':
+            session = self.new_id()
+            self.uploads[session] = {'metadata': body, 'content': b''}
+            return session
+        match = re.fullmatch(r'/drive/v3/files/([^/]+)', path)
+        if match and method == 'GET':
+            file = self.files.get(match.group(1))
+            if file is None:
+                raise FakeError(404, 'File not found.')
+            if query.get('alt', [''])[0] == 'media':
+                return file
+            return self.metadata(file)
+        raise FakeError(404, f'unknown drive call {method} {path}')
+
+    def upload_chunk(self, session, body, headers):
+        '''appends a chunk to a resumable upload, which is complete once the last byte is in'''
+        upload = self.uploads[session]
+        upload['content'] += body
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', headers.get('content-range', ''))
+        end, total = int(match.group(2)), match.group(3)
+        if total != '*' and end + 1 >= int(total):
+            metadata = upload['metadata']
+            file = self.add_file(
+                self.new_id(),
+                metadata.get('name', ''),
+                metadata.get('mimeType', 'application/octet-stream'),
+                metadata.get('parents', []),
+                upload.pop('content'),
+            )
+            del self.uploads[session]
+            return 200, {}, json.dumps({'id': file['id']}).encode()
+        return 308, {'range': f'bytes=0-{end}'}, b''
+
+    # http
+
+    def handle(self, uri, method, body, headers):
+        '''returns (status, extra headers, content bytes)'''
+        parts = urlsplit(uri)
+        query = parse_qs(parts.query)
+        headers = {key.lower(): value for key, value in (headers or {}).items()}
+        # resumable upload chunks come as a stream over a slice of the file
+        if hasattr(body, 'read'):
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode()
+        body = body or b''
+        # a GET whose url would be too long is sent as a POST with the query as a form body
+        if 'x-http-method-override' in headers:
+            method = headers.pop('x-http-method-override')
+            query = parse_qs(body.decode())
+            body = b''
+        with self.lock:
+            try:
+                if parts.path.startswith('/batch/'):
+                    return self.batch(body, headers)
+                if parts.path.startswith('/resumable/'):
+                    return self.upload_chunk(parts.path.rsplit('/', 1)[1], body, headers)
+                payload = json.loads(body) if body and headers.get('content-type', '').startswith('application/json') else {}
+                if parts.netloc.startswith('sheets.'):
+                    return 200, {}, json.dumps(self.sheets(method, parts.path, query, payload)).encode()
+                result = self.drive(method, parts.path, query, payload, headers)
+                if parts.path.startswith('/upload/'):
+                    return 200, {'location': f'https://fake.local/resumable/{result}'}, b''
+                if query.get('alt', [''])[0] == 'media':
+                    return self.media(result['content'], headers)
+                return 200, {}, json.dumps(result).encode()
+            except FakeError as e:
+                error = {'error': {'code': e.status, 'message': e.message}}
+                return e.status, {}, json.dumps(error).encode()
+
+    def media(self, content, headers):
+        match = re.match(r'bytes=(\d+)-(\d+)', headers.get('range', ''))
+        if not match:
+            return 200, {'content-length': str(len(content))}, content
+        start, end = int(match.group(1)), min(int(match.group(2)), len(content) - 1)
+        return 206, {'content-range': f'bytes {start}-{end}/{len(content)}'}, content[start:end + 1]
+
+    def batch(self, body, headers):
+        '''answers a multipart/mixed batch request part by part'''
+        message = email.parser.BytesParser().parsebytes(
+            f'Content-Type: {headers["content-type"]}\r\n\r\n'.encode() + body
+        )
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            head, _, content = re.split(r'(\r?\n\r?\n)', request, maxsplit=1)
+            request_line, *header_lines = head.splitlines()
+            method, path, _ = request_line.split(' ', 2)
+            inner_headers = dict(line.split(': ', 1) for line in header_lines if ': ' in line)
+            status, _, response = self.handle(
+                f'https://www.googleapis.com{path}', method, content, inner_headers
+            )
+            content_id = part['Content-ID'][1:-1]
+            parts.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status < 300 else "Error"}\r\nContent-Type: application/json\r\n\r\n'
+                f'{response.decode()}\r\n'
+            )
+        parts.append(f'--{boundary}--')
+        return 200, {'content-type': f'multipart/mixed; boundary={boundary}'}, ''.join(parts).encode()
+
+
+class FakeHttp:
+    '''httplib2.Http compatible client that answers from a FakeGoogle'''
+    def __init__(self, backend):
+        self.backend = backend
+        self.timeout = None
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        if self.backend.latency:
+            sleep(self.backend.latency)
+        status, extra, content = self.backend.handle(uri, method, body, headers)
+        response = httplib2.Response({'status': str(status), 'content-type': 'application/json', **extra})
+        response.reason = 'OK' if status < 300 else 'Error'
+        return response, content
+
+    def close(self):
+        pass
@@ -0,0 +1,215 @@
+'''offline benchmarks of the app's google api paths against bench/fake_google.py
+
+    streamlit run bench/run.py -- --members 10 100 1000 --latency 0.05
+
+run from the repository root with a .streamlit/secrets.toml holding placeholder values for
+SERVICE_ACCOUNT, FOLDER_ID, PASSWORD and MASTER_ID, nothing is sent to google. every
+scenario starts from empty process caches and reports wall time, api calls and the peak
+python heap. pdfs of the export scenario are filled in worker processes, whose memory is
+not part of the peak.
+'''
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+import zipfile
+from datetime import date, timedelta
+from time import perf_counter
+import pandas as pd
+import streamlit as st
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import utils
+from auth import Authenticator
+from fake_google import FakeGoogle
+from gservices import GServices
+from loader import Loader
+from metrics import get_metrics
+
+# removal runs last, the member it removes is still listed in Members for the others
+SCENARIOS = ('login', 'load', 'load_all', 'rundown', 'provisioning', 'export', 'excel', 'removal')
+GROUP = 'Bench'
+HOUR_TRACKER = 'bench-hour-tracker'
+SCORE_TRACKER = 'bench-score-tracker'
+PASSWORD = 'password'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--members', type=int, nargs='+', default=[10, 100, 1000], help='group sizes to run')
+    parser.add_argument('--entries', type=int, default=50, help='hour entries per member')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake api call')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--throttle', action='store_true', help='keep the production api quotas')
+    parser.add_argument('--snapshots', help='keep tab snapshots in this directory across scenarios, off by default')
+    parser.add_argument('--output', help='also write the results to this json file')
+    return parser.parse_args()
+
+
+def member_names(members):
+    return [f'Member {i:04d}' for i in range(members)]
+
+
+def build_group(fake, members, entries):
+    '''a master spreadsheet, both trackers and a drive folder with one file per member
+
+    the first member supervises everyone else so loading them reads every hour tab
+    '''
+    names = member_names(members)
+    fake.add_spreadsheet(config.MASTER_ID, {
+        config.INFO: [['Group', 'ScoreTracker', 'HourTracker'], [GROUP, SCORE_TRACKER, HOUR_TRACKER]],
+        config.MEMBERS: [['Name', 'Username', 'Password', 'Flags', 'Group', 'Supervisor', 'Email']] + [
+            [name, name.lower().replace(' ', ''), PASSWORD, 'admin' if i == 0 else '', GROUP,
+             '' if i == 0 else names[0], f'{name.lower().replace(" ", ".")}@example.com']
+            for i, name in enumerate(names)
+        ],
+    })
+    today = date.today()
+    fake.add_spreadsheet(SCORE_TRACKER, {
+        config.MAIN: [['Name', config.CLANG_L, config.CLANG_R, config.DLTP_DATE, config.SLTE_DATE]] + [
+            [name, config.SCORE_LEVELS[i % 5 + 2], config.SCORE_LEVELS[i % 4 + 3],
+             str(today - timedelta(days=30 * (i % 12))), str(today - timedelta(days=45 * (i % 8)))]
+            for i, name in enumerate(names)
+        ],
+    })
+    fake.add_spreadsheet(HOUR_TRACKER, {
+        'Log': [['Date', 'Time', 'User', 'Event']],
+        **{
+            name: [config.HOURS_HEADER] + [
+                [str(today - timedelta(days=7 * j)), str(1 + j % 3), 'Listening, Reading', f'entry {j}', '']
+                for j in range(entries)
+            ]
+            for name in names
+        },
+    })
+    fake.add_file(config.FOLDER_ID, 'Members', 'application/vnd.google-apps.folder', [])
+    for name in names:
+        folder = fake.add_file(fake.new_id(), name, 'application/vnd.google-apps.folder', [config.FOLDER_ID])
+        fake.add_file(fake.new_id(), 'certificate.pdf', 'application/pdf', [folder['id']], b'%PDF-1.4' * 512)
+    return names
+
+
+def reset(args, fake):
+    '''empties every process cache so a scenario does not profit from the one before it'''
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    utils.load_template.cache_clear()
+    config.SNAPSHOT_DIR = args.snapshots
+    if not args.throttle:
+        config.SHEETS_READ_QUOTA = config.SHEETS_WRITE_QUOTA = config.DRIVE_QUOTA = 10 ** 9
+    return GServices(None, config.SCOPES, http_factory=fake.http)
+
+
+def login(service, names, fake):
+    Authenticator(service).authenticate(names[0].lower().replace(' ', ''), PASSWORD)
+    assert st.session_state.authenticated, 'login failed'
+
+
+def load(service, names, fake):
+    Loader(service, st.session_state.current_user, GROUP).load_data(background=False)
+
+
+def load_all(service, names, fake):
+    loader = Loader(service, st.session_state.current_user, GROUP)
+    loader.load_data(background=False)
+    for name in loader.DEFERRED:
+        loader.load(name)
+
+
+def rundown(service, names, fake):
+    Loader(service, st.session_state.current_user, GROUP).load_hours()
+    assert st.session_state.hours is not None, 'rundown failed'
+
+
+def provisioning(service, names, fake):
+    '''drops a tenth of the member tabs and folders, then has the admin tools recreate them'''
+    removed = names[::10]
+    with fake.lock:
+        for name in removed:
+            del fake.spreadsheets[HOUR_TRACKER][name], fake.sheet_ids[HOUR_TRACKER][name]
+        for file_id, file in list(fake.files.items()):
+            if file['name'] in removed and config.FOLDER_ID in file['parents']:
+                del fake.files[file_id]
+    tabs, folders = service.provision_members()
+    assert (tabs, folders) == (len(removed), len(removed)), f'provisioned {tabs} tabs and {folders} folders'
+
+
+def removal(service, names, fake):
+    '''removes one member and checks both their hour tab and score tracker row are gone'''
+    name = names[1]
+    service.remove_member({'Name': name}, HOUR_TRACKER, SCORE_TRACKER)
+    assert name not in fake.spreadsheets[HOUR_TRACKER], f'hour tab of {name} was not removed'
+    assert name not in [row[0] for row in fake.spreadsheets[SCORE_TRACKER][config.MAIN]], \
+        f'score tracker row of {name} was not removed'
+
+
+def export(service, names, fake):
+    forms = [(f'{name}.pdf', {'Name': name, 'Date': str(date.today())}) for name in names]
+    utils.create_pdfs(forms).close()
+
+
+def excel(service, names, fake):
+    loader = Loader(service, st.session_state.current_user, GROUP)
+    entries = service.sheets.batch_get({name: 'A:K' for name in names}, loader.group_config['HourTracker'])
+    output = utils.group_to_excel(entries)
+    with zipfile.ZipFile(output) as workbook:
+        sheets = [name for name in workbook.namelist() if name.startswith('xl/worksheets/sheet')]
+    output.close()
+    # one sheet per member behind the summary
+    assert len(sheets) == len(names) + 1, f'exported {len(sheets) - 1} of {len(names)} members'
+
+
+def run(args, members):
+    fake = FakeGoogle(args.latency)
+    names = build_group(fake, members, args.entries)
+    # login populates the session the other scenarios start from
+    st.session_state.authenticated = False
+    login(reset(args, fake), names, fake)
+    results = []
+    for scenario in sorted(args.scenarios, key=SCENARIOS.index):
+        service = reset(args, fake)
+        st.session_state.service = service
+        metrics = get_metrics()
+        tracemalloc.start()
+        start = perf_counter()
+        error = None
+        try:
+            globals()[scenario](service, names, fake)
+        except Exception as e:
+            error = str(e)
+        wall = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        operations = metrics.report()['operations']
+        results.append({
+            'members': members,
+            'scenario': scenario,
+            'wall s': round(wall, 3),
+            'api calls': sum(stats['calls'] for stats in operations.values()),
+            'cache hits': sum(stats['cache_hits'] for stats in operations.values()),
+            'KiB': round(sum(stats['bytes'] for stats in operations.values()) / 1024, 1),
+            'peak MiB': round(peak / 2 ** 20, 1),
+            'calls': {operation: stats['calls'] for operation, stats in operations.items()},
+            'error': error,
+        })
+    return results
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    utils.initialize_session_state_variables(config.SESSION_VARS)
+    results = []
+    for members in args.members:
+        results.extend(run(args, members))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    st.subheader('Benchmarks')
+    st.caption(f'fake api latency {args.latency * 1000:.0f} ms, {args.entries} entries per member')
+    st.dataframe(pd.DataFrame(results).drop(columns=['calls']), use_container_width=True)
+    with st.expander('Calls by operation'):
+        st.dataframe(pd.DataFrame([dict(r['calls'], members=r['members'], scenario=r['scenario']) for r in results]))
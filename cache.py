@@ -0,0 +1,272 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class TabCache:
+    '''LRU cache of sheet tabs shared by every session in the process
+
+    entries are keyed by (worksheet_id, tab_name, ...) and expire after ttl seconds.
+    every tab and spreadsheet carries a version that is bumped on invalidation,
+    so a read that raced with one of our own writes is never stored.
+
+    expired entries stay until they are evicted, together with the watermark of the read
+    that produced them, so Sheets.refresh() can bring them up to date by reading only the
+    rows appended since. entries also keep the drive modifiedTime their spreadsheet had
+    before they were read, an expired entry is renewed when it is still the same.
+    '''
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.marks = {}
+        self.versions = {}
+        # spreadsheet id -> (drive modifiedTime, monotonic time it was checked)
+        self.modified = {}
+        self.lock = threading.RLock()
+
+    def version(self, worksheet_id, tab_name):
+        '''returns a token to pass back to put() once the read finishes'''
+        with self.lock:
+            return (
+                self.versions.get((worksheet_id, None), 0),
+                self.versions.get((worksheet_id, tab_name), 0),
+            )
+
+    def get(self, key, stale=False):
+        '''returns a copy of the cached dataframe, or None on a miss
+
+        stale also returns an entry that expired or was invalidated by an append
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            df, size, expires, revision = entry
+            if expires < monotonic() and not stale:
+                return None
+            self.entries.move_to_end(key)
+        return df.copy()
+
+    def mark(self, key):
+        '''the watermark stored with the last read of key, or None'''
+        with self.lock:
+            return self.marks.get(key)
+
+    def revision(self, key):
+        '''modifiedTime of the spreadsheet before key was read, or None'''
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry[3] if entry is not None else None
+
+    def renew(self, key):
+        '''restarts the ttl of an entry whose spreadsheet did not change'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries[key] = entry[:2] + (monotonic() + self.ttl, entry[3])
+
+    def modified_time(self, worksheet_id, max_age):
+        '''the spreadsheet's modifiedTime if it was checked in the last max_age seconds'''
+        with self.lock:
+            modified, checked = self.modified.get(worksheet_id, (None, 0))
+            return modified if monotonic() - checked <= max_age else None
+
+    def set_modified_times(self, times):
+        now = monotonic()
+        with self.lock:
+            for worksheet_id, modified in times.items():
+                self.modified[worksheet_id] = (modified, now)
+
+    def put(self, key, df, version, mark=None, revision=None, fresh=True):
+        '''stores a read, returns False if a write raced with it and nothing was stored
+
+        an entry put with fresh=False is only served stale, until it is renewed or replaced
+        '''
+        worksheet_id, tab_name = key[:2]
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        df = df.copy()
+        with self.lock:
+            # a write landed while this tab was being read, the data may be stale
+            if version != self.version(worksheet_id, tab_name):
+                return False
+            self.pop(key)
+            if mark is not None:
+                self.marks[key] = mark
+            if size > self.max_bytes:
+                return True
+            self.entries[key] = (df, size, monotonic() + self.ttl if fresh else 0, revision)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.pop(next(iter(self.entries)))
+            return True
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def invalidate(self, worksheet_id, tab_name=None, appended=False):
+        '''drops every range of a tab, or of the whole spreadsheet when no tab is given
+
+        appended only expires the entries, rows under their watermarks are unchanged
+        '''
+        with self.lock:
+            self.versions[(worksheet_id, tab_name)] = self.versions.get((worksheet_id, tab_name), 0) + 1
+            # our own write moved the modifiedTime on, a check from before it is out of date
+            self.modified.pop(worksheet_id, None)
+            for key in list(self.entries):
+                if key[0] == worksheet_id and (tab_name is None or key[1] == tab_name):
+                    if appended:
+                        df, size, expires, revision = self.entries[key]
+                        self.entries[key] = (df, size, 0, revision)
+                    else:
+                        self.pop(key)
+            if not appended:
+                for key in list(self.marks):
+                    if key[0] == worksheet_id and (tab_name is None or key[1] == tab_name):
+                        del self.marks[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.marks.clear()
+            self.modified.clear()
+            self.size = 0
+
+
+class FolderIndex:
+    '''name to folder id index of the member folders, shared by every session
+
+    synced holds the time of the last listing so the next refresh only asks
+    drive for folders created after it.
+    '''
+    def __init__(self):
+        self.folders = {}
+        self.synced = None
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            return self.folders.get(name)
+
+    def add(self, name, folder_id):
+        with self.lock:
+            self.folders[name] = folder_id
+
+    def update(self, files, synced):
+        with self.lock:
+            for file in files:
+                self.folders[file['name']] = file['id']
+            self.synced = synced
+
+
+class TabRegistry:
+    '''tab name to sheet properties of each spreadsheet, shared by every session
+
+    a spreadsheet is listed with one spreadsheets.get and kept up to date by our own
+    addSheet and deleteSheet requests. it is listed again after ttl seconds to pick up
+    tabs added or removed outside the app.
+    '''
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.spreadsheets = {}
+        self.lock = threading.Lock()
+
+    def get(self, worksheet_id):
+        '''returns a dict of tab name to properties, or None if unknown or expired'''
+        with self.lock:
+            tabs, expires = self.spreadsheets.get(worksheet_id, (None, 0))
+            if tabs is None or expires < monotonic():
+                return None
+            return dict(tabs)
+
+    def set(self, worksheet_id, sheets):
+        with self.lock:
+            self.spreadsheets[worksheet_id] = (
+                {sheet['properties']['title']: sheet['properties'] for sheet in sheets},
+                monotonic() + self.ttl,
+            )
+
+    def add(self, worksheet_id, properties):
+        with self.lock:
+            if worksheet_id in self.spreadsheets:
+                self.spreadsheets[worksheet_id][0][properties['title']] = properties
+
+    def remove(self, worksheet_id, sheet_id):
+        with self.lock:
+            if worksheet_id in self.spreadsheets:
+                tabs = self.spreadsheets[worksheet_id][0]
+                for title, properties in list(tabs.items()):
+                    if properties['sheetId'] == sheet_id:
+                        del tabs[title]
+
+    def forget(self, worksheet_id):
+        with self.lock:
+            self.spreadsheets.pop(worksheet_id, None)
+
+
+class RowIndex:
+    '''name to sheet row of keyed tabs such as Members and Main, shared by every session
+
+    rows are sheet row numbers, the header being row 1. a tab's index is rebuilt from a
+    read and shifted in place by our own row deletions and appends, so finding a member's
+    row does not need the tab to be read again.
+    '''
+    def __init__(self):
+        self.tabs = {}
+        self.lock = threading.Lock()
+
+    def set(self, worksheet_id, tab_name, df, key):
+        '''indexes a tab read into df, whose index is the data row number'''
+        rows = {}
+        # the first row of a duplicated name wins, as a boolean mask lookup would
+        for index, name in reversed(list(zip(df.index, df[key]))):
+            rows[name] = int(index) + 1
+        with self.lock:
+            self.tabs[(worksheet_id, tab_name)] = {'column': df.columns.get_loc(key), 'rows': rows}
+
+    def get(self, worksheet_id, tab_name, name):
+        '''returns (row, column position of the key) or None'''
+        with self.lock:
+            tab = self.tabs.get((worksheet_id, tab_name))
+            if tab is None or name not in tab['rows']:
+                return None
+            return tab['rows'][name], tab['column']
+
+    def delete(self, worksheet_id, tab_name, start, end):
+        '''removes zero-based rows start up to end, as a deleteDimension range, and shifts the rest up'''
+        with self.lock:
+            tab = self.tabs.get((worksheet_id, tab_name))
+            if tab is None:
+                return
+            tab['rows'] = {
+                name: row - (end - start) if row > end else row
+                for name, row in tab['rows'].items()
+                if not start < row <= end
+            }
+
+    def append(self, worksheet_id, tab_name, first_row, values):
+        '''adds rows appended from first_row on'''
+        with self.lock:
+            tab = self.tabs.get((worksheet_id, tab_name))
+            if tab is None:
+                return
+            for row, value in enumerate(values, start=first_row):
+                if len(value) > tab['column']:
+                    tab['rows'].setdefault(value[tab['column']], row)
+
+    def rename(self, worksheet_id, tab_name, row, name):
+        with self.lock:
+            tab = self.tabs.get((worksheet_id, tab_name))
+            if tab is None:
+                return
+            tab['rows'] = {key: value for key, value in tab['rows'].items() if value != row}
+            tab['rows'][name] = row
+
+    def forget(self, worksheet_id, tab_name=None):
+        with self.lock:
+            for key in list(self.tabs):
+                if key[0] == worksheet_id and tab_name in (None, key[1]):
+                    del self.tabs[key]
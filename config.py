@@ -2,11 +2,17 @@ import streamlit as st
 
 
 
-DB_USERNAME = st.secrets['DB_USERNAME']
-DB_PASSWORD = st.secrets['DB_PASSWORD']
-HOST = st.secrets['HOST']
-PORT = st.secrets['PORT']
-DB_NAME = st.secrets['DB_NAME']
+DB_USERNAME = st.secrets.get('DB_USERNAME')
+DB_PASSWORD = st.secrets.get('DB_PASSWORD')
+HOST = st.secrets.get('HOST')
+PORT = st.secrets.get('PORT')
+DB_NAME = st.secrets.get('DB_NAME')
+# a full sqlalchemy url, e.g. sqlite:///language_hours.db, overrides the mysql settings above
+DB_URL = st.secrets.get('DB_URL', f'mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{HOST}/{DB_NAME}')
+DB_POOL_SIZE = 10 # connections kept open in the pool
+DB_MAX_OVERFLOW = 20 # extra connections allowed under load
+DB_POOL_TIMEOUT = 30 # seconds to wait for a free connection
+DB_POOL_RECYCLE = 1800 # seconds before a connection is replaced, below mysql's wait_timeout
 
 
 URL = 'https://docs.google.com/spreadsheets/d/'
@@ -28,17 +34,19 @@ SESSION_VARS = [
     'current_user', # user accessing the site
     'authenticated', # has user successfully logged into the site
     'current_group', # group string
-    'req_count', # number of requests to google services
     'members', # list of all members of the group
     'config', # user config
     'debug', # debug mode toggle
     'score_tracker',
     'show_total_month_hours',
     'total_month_all', # all members monthly hours, displayed in the rundown
+    'hours', # member by month hours matrix of the group
+    'loader', # loads the session's data on demand
 ]
 INFO = 'Info'
 MAIN = 'Main'
 MEMBERS = 'Members'
+ROW_KEY = 'Name' # column the row index of keyed tabs such as Members and Main is built on
 DICODES = ['AU', 'AP', 'AE', 'DG', 'AD', 'AV', 'PV', 'PG', 'PF',]
 CLANG_L = 'CLang L'
 CLANG_R = 'CLang R'
@@ -49,6 +57,7 @@ SLTE_RANGE = {
     '2': 18,
     '1': 12,
 }
+HOURS_HEADER = ['Date', 'Hours', 'Modality', 'Description', 'Vocab'] # header row of a member hour tab
 ACTIVITIES = [
     'Listening',
     'Reading',
@@ -61,3 +70,42 @@ ACTIVITIES = [
     'ILTP upload',
     '623A upload',
 ]
+CACHE_TTL = 300 # seconds a cached tab is served before it is read again
+CACHE_MAX_BYTES = 128 * 1024 * 1024 # memory bound of the process-wide tab cache
+MODIFIED_CHECK_INTERVAL = 15 # seconds a spreadsheet's drive modifiedTime is trusted before it is checked again
+DELTA_MAX_AGE = 4 * CACHE_TTL # seconds after a full read of a tab that refresh() may extend it with appended rows only
+SNAPSHOT_DIR = st.secrets.get('SNAPSHOT_DIR') # directory tab reads are kept in across restarts, off when unset
+SNAPSHOT_EXCLUDE = [MEMBERS] # tabs never written to disk, Members holds the passwords
+MAX_WORKERS = 8 # concurrent google api requests a single session may run
+PREFETCH = True # load the datasets the first page does not need in a background thread after login
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024 # resumable upload chunk size, must be a multiple of 256 KiB
+SCORE_LEVELS = ['0', '0+', '1', '1+', '2', '2+', '3', '3+', '4'] # lowest to highest
+# column types applied when a tab is read, member hour tabs use HOURS_SCHEMA
+HOURS_SCHEMA = {
+    'Date': 'datetime',
+    'Hours': 'numeric',
+    'Modality': 'category',
+}
+SCHEMAS = {
+    INFO: {'Group': 'category'},
+    MEMBERS: {'Group': 'category'},
+    MAIN: {
+        CLANG_L: 'score',
+        CLANG_R: 'score',
+        DLTP_DATE: 'datetime',
+        SLTE_DATE: 'datetime',
+    },
+    'Log': {},
+}
+SPOOL_MAX_SIZE = 16 * 1024 * 1024 # generated exports move from memory to a temp file past this size
+EXCEL_DATE_FORMAT = 'yyyy-mm-dd' # number format of date cells in excel exports
+WRITE_BATCH_ROWS = 50 # pending rows that trigger a background append for a tab
+WRITE_INTERVAL = 5 # seconds between background appends
+WRITE_MAX_PENDING = 1000 # rows buffered across all tabs before writers block
+# google api per-minute quotas, shared by every session in the process
+SHEETS_READ_QUOTA = 60
+SHEETS_WRITE_QUOTA = 60
+DRIVE_QUOTA = 12000
+RETRY_LIMIT = 5 # retries of a rate limited or failed api call
+RETRY_BASE = 1 # seconds, backoff doubles from here on every retry
+RETRY_CAP = 32 # seconds, longest wait between retries
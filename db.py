@@ -1,15 +1,16 @@
-from sqlalchemy import create_engine, Column, Integer, String, Sequence, Boolean, Date, DateTime, ForeignKey, ARRAY, LargeBinary
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+from sqlalchemy import create_engine, Column, Integer, String, Sequence, Boolean, Date, DateTime, ForeignKey, ARRAY, LargeBinary, Text, Index, func, case
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship, declarative_base
 from sqlalchemy_utils import create_database, database_exists
+from contextlib import contextmanager
 import pandas as pd
-from datetime import datetime
+from datetime import date, datetime
 import json
-from config import DB_USERNAME, DB_PASSWORD, HOST, DB_NAME
+import config
 import streamlit as st
 
 # Define the SQLAlchemy model for your table
 Base = declarative_base()
-engine = create_engine(f'mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{HOST}/{DB_NAME}')
 
 
 class User(Base):
@@ -43,14 +44,20 @@ class Course(Base):
     end_date = Column(Date)
     user = relationship('User', back_populates='courses')
 
+def modality_mask(modalities):
+    '''bitmask of activities, bit i is set for config.ACTIVITIES[i]'''
+    return sum(1 << config.ACTIVITIES.index(m) for m in set(modalities) if m in config.ACTIVITIES)
+
 class LanguageHour(Base):
     __tablename__ = 'language_hours'
+    __table_args__ = (Index('ix_language_hours_user_date', 'user_id', 'date'),)
     id = Column(Integer, Sequence('language_hour_id_seq'), primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))  # Define foreign key relationship
     date = Column(Date)
     hours = Column(Integer)
     description = Column(String(250))
     modalities = Column(String(100))
+    modality_mask = Column(Integer, default=0) # filterable copy of modalities, see modality_mask()
     user = relationship('User', back_populates='language_hours')
 
     def __init__(self, date, hours, description, modalities, user_id):
@@ -58,6 +65,7 @@ class LanguageHour(Base):
         self.hours = hours
         self.description = description
         self.modalities = json.dumps(modalities)  # Serialize array to JSON string
+        self.modality_mask = modality_mask(modalities)
         self.user_id = user_id
 
     @property
@@ -66,6 +74,7 @@ class LanguageHour(Base):
 
 class Score(Base):
     __tablename__ = 'scores'
+    __table_args__ = (Index('ix_scores_user_date', 'user_id', 'date'),)
     id = Column(Integer, Sequence('score_id_seq'), primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))  # Define a foreign key relationship
     langauge = Column(String(50))
@@ -99,9 +108,35 @@ class Message(Base):
     content = Column(String(255))
     timestamp = Column(DateTime, default=datetime.utcnow)
 
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    id = Column(Integer, Sequence('sync_state_id_seq'), primary_key=True)
+    worksheet_id = Column(String(100))
+    tab = Column(String(100))
+    rows = Column(Integer, default=0) # high-water mark, rows already mirrored
+    digest = Column(String(64)) # digest of the rows under the high-water mark
+    row_hashes = Column(Text) # keyed tabs, json of row key to row hash
+    synced = Column(DateTime)
+
 @st.cache_resource
-def create_db():
-    '''creates engine and returns session'''
+def get_engine():
+    '''engine and connection pool shared by every session in the process'''
+    url = make_url(config.DB_URL)
+    options = {'pool_pre_ping': True}
+    # sqlite uses its own single connection pools that take no sizing
+    if url.get_backend_name() != 'sqlite':
+        options.update(
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_recycle=config.DB_POOL_RECYCLE,
+        )
+    return create_engine(url, **options)
+
+@st.cache_resource
+def get_session_factory():
+    '''creates the database and tables if needed, returns a thread scoped session factory'''
+    engine = get_engine()
     if not database_exists(engine.url):
         try:
             create_database(engine.url)
@@ -114,18 +149,98 @@ def create_db():
         conn.close()
     except Exception as e:
         print('Error:', e)
-    # Create an SQLalchemy engine and session
-    #engine = create_engine(DATABASE_URI)  # Replace with your database connection details
-    #Base.metadata.drop_all(engine)
-    
-    Session = sessionmaker(bind=engine)
-    session = Session()
     # Create the table if it doesn't exist
     Base.metadata.create_all(engine)
-    return session
+    return scoped_session(sessionmaker(bind=engine))
+
+@contextmanager
+def session_scope():
+    '''the session of the calling script run, each run gets its own
+
+    commits on success, rolls back on error and always releases the session so its
+    connection goes back to the pool. every database access goes through here.
+    '''
+    Session = get_session_factory()
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
+
+def pool_status():
+    '''connection pool statistics of the shared engine'''
+    pool = get_engine().pool
+    stats = {'status': pool.status()}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
 
 def clear_db():
-    Base.metadata.drop_all(engine)
+    Base.metadata.drop_all(get_engine())
+
+def month_range(year, month):
+    '''first day of the month and first day of the next, for index friendly range filters'''
+    start = date(year, month, 1)
+    end = date(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+def monthly_hours(session, year, month, group_id=None):
+    '''total hours per user for one month, returns a dict of user id to hours'''
+    start, end = month_range(year, month)
+    query = session.query(
+        LanguageHour.user_id, func.sum(LanguageHour.hours)
+    ).filter(LanguageHour.date >= start, LanguageHour.date < end)
+    if group_id is not None:
+        query = query.join(User, User.id == LanguageHour.user_id).filter(User.group_id == group_id)
+    return dict(query.group_by(LanguageHour.user_id).all())
+
+def group_monthly_hours(session, group_id, start=None, end=None):
+    '''total hours of a group per month, returns a dict of (year, month) to hours'''
+    year = func.extract('year', LanguageHour.date)
+    month = func.extract('month', LanguageHour.date)
+    query = session.query(year, month, func.sum(LanguageHour.hours)).join(
+        User, User.id == LanguageHour.user_id
+    ).filter(User.group_id == group_id)
+    if start is not None:
+        query = query.filter(LanguageHour.date >= start)
+    if end is not None:
+        query = query.filter(LanguageHour.date < end)
+    rows = query.group_by(year, month).all()
+    return {(int(y), int(m)): hours for y, m, hours in rows}
+
+def modality_breakdown(session, user_id=None, group_id=None, start=None, end=None):
+    '''hours per activity in one pass over the bitmask, returns a dict of activity to hours'''
+    columns = [
+        func.sum(case((LanguageHour.modality_mask.op('&')(1 << i) != 0, LanguageHour.hours), else_=0))
+        for i in range(len(config.ACTIVITIES))
+    ]
+    query = session.query(*columns)
+    if user_id is not None:
+        query = query.filter(LanguageHour.user_id == user_id)
+    if group_id is not None:
+        query = query.join(User, User.id == LanguageHour.user_id).filter(User.group_id == group_id)
+    if start is not None:
+        query = query.filter(LanguageHour.date >= start)
+    if end is not None:
+        query = query.filter(LanguageHour.date < end)
+    return {activity: hours or 0 for activity, hours in zip(config.ACTIVITIES, query.one())}
+
+def latest_scores(session, group_id=None):
+    '''the most recent score of every user'''
+    latest = session.query(
+        Score.user_id, func.max(Score.date).label('date')
+    ).group_by(Score.user_id).subquery()
+    query = session.query(Score).join(
+        latest, (Score.user_id == latest.c.user_id) & (Score.date == latest.c.date)
+    )
+    if group_id is not None:
+        query = query.join(User, User.id == Score.user_id).filter(User.group_id == group_id)
+    return query.all()
 
 ## Query the data from the table
 #users = session.query(User).all()
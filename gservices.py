@@ -1,49 +1,231 @@
-from datetime import date, datetime
+from datetime import date, datetime, timedelta, timezone
 from io import BytesIO
-from urllib.error import HTTPError
 import streamlit as st
 import pandas as pd
+import re
+import threading
+import httplib2
 from google.oauth2 import service_account
-from googleapiclient.discovery import build, MediaFileUpload
-from googleapiclient.http import MediaIoBaseDownload
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
 import inspect
 import config
+from time import perf_counter, sleep, time
+from cache import FolderIndex, RowIndex, TabCache, TabRegistry
+from concurrent.futures import ThreadPoolExecutor
+from metrics import get_metrics
+from ratelimit import TokenBucket, backoff, is_retryable
+from snapshots import SnapshotStore
+from writebehind import WriteBehindQueue
+
+
+@st.cache_resource
+def get_tab_cache():
+    '''tab cache shared by every session in the process'''
+    return TabCache(config.CACHE_TTL, config.CACHE_MAX_BYTES)
+
+
+@st.cache_resource
+def get_tab_registry():
+    '''tab name to sheetId registry shared by every session in the process'''
+    return TabRegistry(config.CACHE_TTL)
+
+
+@st.cache_resource
+def get_row_index():
+    '''name to row index of keyed tabs shared by every session in the process'''
+    return RowIndex()
+
+
+@st.cache_resource
+def get_snapshot_store():
+    '''on-disk tab snapshots shared by every session in the process, None when disabled'''
+    if not config.SNAPSHOT_DIR:
+        return None
+    store = SnapshotStore(config.SNAPSHOT_DIR)
+    # snapshots taken before a tab was excluded
+    store.purge(config.SNAPSHOT_EXCLUDE)
+    return store
+
+
+@st.cache_resource
+def get_write_queue(_sheets):
+    '''background append queue shared by every session in the process'''
+    return WriteBehindQueue(
+        _sheets.write_data,
+        max_rows=config.WRITE_BATCH_ROWS,
+        interval=config.WRITE_INTERVAL,
+        max_pending=config.WRITE_MAX_PENDING,
+    )
+
+
+@st.cache_resource
+def get_limiters():
+    '''per-minute quota buckets shared by every session in the process'''
+    return {
+        'sheets.read': TokenBucket(config.SHEETS_READ_QUOTA),
+        'sheets.write': TokenBucket(config.SHEETS_WRITE_QUOTA),
+        'drive': TokenBucket(config.DRIVE_QUOTA),
+    }
+
+
+@st.cache_resource
+def get_discovery_document(service_name, version):
+    '''discovery document bundled with googleapiclient, read once per process'''
+    document = get_static_doc(service_name, version)
+    if document is None:
+        raise ValueError(f'no bundled discovery document for {service_name} {version}')
+    return document
+
+
+def build_client(service_name, version, credentials, http_factory=None):
+    '''builds an api client from the bundled discovery document, nothing is fetched'''
+    return build_from_document(
+        get_discovery_document(service_name, version),
+        credentials=credentials,
+        http=http_factory() if http_factory else None,
+    )
+
+
+def column_letter(position):
+    '''a1 letters of a zero-based column position, 0 -> A, 26 -> AA'''
+    letters = ''
+    position += 1
+    while position:
+        position, remainder = divmod(position - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+@st.cache_resource
+def get_folder_index():
+    '''member folder index shared by every session in the process'''
+    return FolderIndex()
+
+
+class ApiClient:
+    '''base of the api wrappers, runs every request on a per-thread connection and records it'''
+    def __init__(self, credentials, http_factory=None):
+        self.credentials = credentials
+        self.http_factory = http_factory
+        self.local = threading.local()
+        self.metrics = get_metrics()
+        self.limiters = get_limiters()
+
+    def http(self):
+        '''httplib2 is not thread safe, each thread gets its own authorized connection'''
+        if not hasattr(self.local, 'http'):
+            if self.http_factory is not None:
+                self.local.http = self.http_factory()
+            else:
+                self.local.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+        return self.local.http
+
+    def execute(self, request, operation, target='', idempotent=True):
+        '''executes a request and records its latency and response size under operation and target'''
+        size = 0
+        postproc = request.postproc
+
+        def count_bytes(resp, content):
+            nonlocal size
+            size = len(content or b'')
+            return postproc(resp, content)
+
+        request.postproc = count_bytes
+        return self.timed(
+            operation, target, lambda: request.execute(http=self.http()), lambda: size, idempotent=idempotent
+        )
+
+    def quota(self, operation):
+        if operation.startswith('drive'):
+            return 'drive'
+        if operation in ('sheets.get', 'sheets.values.get', 'sheets.values.batchGet'):
+            return 'sheets.read'
+        return 'sheets.write'
+
+    def timed(self, operation, target, call, payload=lambda: 0, cost=1, idempotent=True):
+        '''runs call() as one api call and records it, payload() returns the bytes it moved
+
+        every attempt waits for cost tokens from the operation's quota bucket. rate limited,
+        and for idempotent calls failed, attempts are retried with jittered exponential backoff.
+        '''
+        quota = self.quota(operation)
+        retries = 0
+        error = False
+        start = perf_counter()
+        try:
+            while True:
+                depth = self.limiters[quota].acquire(cost)
+                self.metrics.gauge(f'{quota} queue depth', depth)
+                try:
+                    return call()
+                except Exception as e:
+                    if retries >= config.RETRY_LIMIT or not is_retryable(e, idempotent):
+                        raise
+                    sleep(backoff(retries, e, config.RETRY_BASE, config.RETRY_CAP))
+                    retries += 1
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.metrics.record(operation, target, perf_counter() - start, payload(), retries, error)
 
 
 class GServices:
     '''google services connection to gmail, gsheets, and google drive'''
-    def __init__(self, account_info, scopes):
-        self.credentials = service_account.Credentials.from_service_account_info(
-            info=account_info,
-            scopes=scopes,
-        )
-        self.mail = self.Mail(self.credentials)
-        self.sheets = self.Sheets(self.credentials)
-        self.drive = self.Drive(self.credentials)
+    def __init__(self, account_info, scopes, http_factory=None):
+        '''http_factory, a callable returning an httplib2.Http compatible object, replaces the
+        google endpoints and credentials, e.g. with the fake backend in bench/'''
+        self.credentials = None
+        if http_factory is None:
+            self.credentials = service_account.Credentials.from_service_account_info(
+                info=account_info,
+                scopes=scopes,
+            )
+        self.http_factory = http_factory
+        self._mail = None
+        self.mail_lock = threading.Lock()
+        self.sheets = self.Sheets(self.credentials, http_factory)
+        self.drive = self.Drive(self.credentials, http_factory)
+        # sheets asks drive whether a spreadsheet changed before reading it again
+        self.sheets.modified_times = self.drive.modified_times
         self.bulk_utils = self.BulkUtils()
         self.members = self.Members()
 
+    @property
+    def mail(self):
+        '''the gmail client, built on first use since most sessions never send mail'''
+        with self.mail_lock:
+            if self._mail is None:
+                self._mail = self.Mail(self.credentials, self.http_factory)
+            return self._mail
 
     class Mail:
         '''functions to interact with gmail'''
-        def __init__(self, credentials):
-            self.mail = build(
-                serviceName='gmail',
-                version='v1',
-                credentials=credentials,
-                cache_discovery=False,
-            )
+        def __init__(self, credentials, http_factory=None):
+            self.mail = build_client('gmail', 'v1', credentials, http_factory)
 
 
-    class Sheets:
+    class Sheets(ApiClient):
         '''functions to interact with the google sheet'''
-        def __init__(self, credentials):
-            self.sheets = build(
-                serviceName='sheets',
-                version='v4',
-                credentials=credentials,
-                cache_discovery=False,
-            )
+        def __init__(self, credentials, http_factory=None):
+            super().__init__(credentials, http_factory)
+            self.sheets = build_client('sheets', 'v4', credentials, http_factory)
+            self.cache = get_tab_cache()
+            self.registry = get_tab_registry()
+            self.rows = get_row_index()
+            self.queue = get_write_queue(self)
+            # callable returning {spreadsheet id: drive modifiedTime}, set by GServices
+            self.modified_times = None
+            self.snapshots = get_snapshot_store()
+            # cache keys restored from a snapshot, and those still being reconciled with the sheet
+            self.restored = set()
+            self.reconciling = set()
+            self.reconcile_lock = threading.Lock()
+            self.reconciler = ThreadPoolExecutor(max_workers=config.MAX_WORKERS, thread_name_prefix='reconcile')
 
         def add_tab(self, tab_name, hour_tracker):
             body = {
@@ -60,81 +242,468 @@ class GServices:
             try:
                 r = self.batch_update(body, hour_tracker)
                 return True
-            except HTTPError as e:
+            except HttpError as e:
                 print(e)
                 return False
 
-        def get_tab_id(self, tab_name, worksheet_id):
-            sheet_id = None
+        def get_tabs(self, worksheet_id, refresh=False):
+            '''returns a dict of tab name to sheet properties, listed once and then kept in the registry'''
+            tabs = None if refresh else self.registry.get(worksheet_id)
+            if tabs is None:
+                r = self.execute(self.sheets.spreadsheets().get(
+                    spreadsheetId=worksheet_id,
+                    fields='sheets.properties',
+                ), 'sheets.get', worksheet_id)
+                self.registry.set(worksheet_id, r.get('sheets', []))
+                tabs = self.registry.get(worksheet_id)
+            return tabs
+
+        def get_tab_titles(self, worksheet_id):
+            return set(self.get_tabs(worksheet_id))
+
+        def add_tabs(self, tab_names, worksheet_id, header):
+            '''adds every tab in one batchUpdate, then writes all of their header rows in one values.batchUpdate'''
+            if not tab_names:
+                return {}
+            body = {
+                'requests': [
+                    {'addSheet': {'properties': {'title': tab_name}}}
+                    for tab_name in tab_names
+                ]
+            }
+            r = self.batch_update(body, worksheet_id)
+            if r is None:
+                return None
+            data = [
+                {
+                    'range': f'{tab_name}!A1',
+                    'majorDimension': 'ROWS',
+                    'values': [list(header)],
+                }
+                for tab_name in tab_names
+            ]
             try:
-                data = self.sheets.get(
+                self.execute(self.sheets.spreadsheets().values().batchUpdate(
                     spreadsheetId=worksheet_id,
-                ).execute()
-            except HTTPError as e:
+                    body={'valueInputOption': 'USER_ENTERED', 'data': data},
+                ), 'sheets.values.batchUpdate', worksheet_id)
+            except HttpError as e:
+                print(e)
+            finally:
+                self.invalidate(worksheet_id)
+            return r
+
+        def get_tab_id(self, tab_name, worksheet_id):
+            '''sheetId of a tab from the registry, None if the spreadsheet has no such tab'''
+            try:
+                tabs = self.get_tabs(worksheet_id)
+                if tab_name not in tabs:
+                    # the tab may have been added outside the app since the last listing
+                    tabs = self.get_tabs(worksheet_id, refresh=True)
+            except HttpError as e:
                 print(inspect.getframeinfo(inspect.currentframe())[2], e)
-            for sheet in data['sheets']:
-                if sheet['properties']['title'] == tab_name:
-                    sheet_id = sheet['properties']['sheetId']
-                    break
-            return sheet_id
+                return None
+            properties = tabs.get(tab_name)
+            return properties['sheetId'] if properties is not None else None
+
+        def get_data(self, columns, tab_name, worksheet_id, range='A:K', unformatted=False):
+            '''reads a tab into a dataframe typed by its schema in config.SCHEMAS
+
+            unformatted requests raw values, with dates as serial numbers, instead of display strings
+            '''
+            key = (worksheet_id, tab_name, range, unformatted)
+            df = self.cache.get(key)
+            if df is None:
+                df = self.unchanged(key)
+            if df is None:
+                df = self.restore(key)
+            if df is not None:
+                self.metrics.hit('sheets.values.get', tab_name)
+            else:
+                version = self.cache.version(worksheet_id, tab_name)
+                revision = self.revision(worksheet_id)
+                try:
+                    values = self.execute(self.sheets.spreadsheets().values().get(
+                        spreadsheetId=worksheet_id,
+                        range=f"{tab_name}!{range}",
+                        **self.render_options(unformatted),
+                    ), 'sheets.values.get', tab_name)
+                except HttpError as e:
+                    print(e)
+                    return
+                df = self.to_frame(values.get('values'), tab_name, unformatted)
+                if df is not None:
+                    self.store(key, df, version, self.watermark(values.get('values')), revision)
+            return df.get(columns) if columns != None and df is not None else df
+
+        def store(self, key, df, version, mark, revision):
+            '''caches a read and snapshots it to disk unless a write raced with it'''
+            if not self.cache.put(key, df, version, mark, revision):
+                return
+            # row positions only line up with the index for ranges starting at column A
+            if config.ROW_KEY in df.columns and re.match(r'A(?![A-Z])', key[2]):
+                self.rows.set(key[0], key[1], df, config.ROW_KEY)
+            if self.snapshots is not None and key[1] not in config.SNAPSHOT_EXCLUDE:
+                self.snapshots.save(key, df.copy(), revision, mark)
+
+        def find_row(self, name, tab_name, worksheet_id, range='A:K'):
+            '''sheet row of the member called name in a keyed tab, or None
+
+            the row comes from the row index and is checked against the sheet by reading the
+            one cell that should hold the name. the tab is only read in full to build the index,
+            or to rebuild it when the check fails because rows moved outside the app.
+            '''
+            # range is the tab's cell range here, the builtin is shadowed
+            for attempt in (0, 1):
+                found = self.rows.get(worksheet_id, tab_name, name)
+                if found is None:
+                    df = self.get_data(None, tab_name, worksheet_id, range)
+                    if df is None or config.ROW_KEY not in df.columns:
+                        return None
+                    self.rows.set(worksheet_id, tab_name, df, config.ROW_KEY)
+                    found = self.rows.get(worksheet_id, tab_name, name)
+                    if found is None:
+                        return None
+                row, column = found
+                cell = f"{tab_name}!{column_letter(column)}{row}"
+                try:
+                    r = self.execute(self.sheets.spreadsheets().values().get(
+                        spreadsheetId=worksheet_id,
+                        range=cell,
+                    ), 'sheets.values.get', tab_name)
+                except HttpError as e:
+                    print(e)
+                    return None
+                if r.get('values', [['']])[0][:1] == [name]:
+                    return row
+                self.rows.forget(worksheet_id, tab_name)
+                self.invalidate(worksheet_id, tab_name)
+            return None
+
+        def invalidate(self, worksheet_id, tab_name=None, appended=False):
+            '''drops cached reads after a write, snapshots survive appends like the watermarks do'''
+            self.cache.invalidate(worksheet_id, tab_name, appended)
+            if not appended and self.snapshots is not None:
+                self.snapshots.discard(worksheet_id, tab_name)
+
+        def restore(self, key):
+            '''the first read of a tab after a restart is served from its snapshot
+
+            the snapshot goes into the cache as a stale entry and is reconciled with the sheet in
+            the background through refresh(), reads of the tab meanwhile are served the snapshot
+            '''
+            if self.snapshots is None or key[1] in config.SNAPSHOT_EXCLUDE:
+                return None
+            with self.reconcile_lock:
+                if key in self.restored:
+                    return self.cache.get(key, stale=True) if key in self.reconciling else None
+                self.restored.add(key)
+                self.reconciling.add(key)
+            snapshot = self.snapshots.load(key)
+            if snapshot is None:
+                self.reconciling.discard(key)
+                return None
+            df, metadata = snapshot
+            self.cache.put(
+                key,
+                df,
+                self.cache.version(*key[:2]),
+                metadata['mark'],
+                metadata['revision'],
+                fresh=False,
+            )
+            self.reconciler.submit(self.reconcile, key)
+            return df
+
+        def reconcile(self, key):
+            worksheet_id, tab_name, range, unformatted = key
+            try:
+                self.refresh(tab_name, worksheet_id, range=range, unformatted=unformatted, restore=False)
+            except Exception as e:
+                print(f'could not reconcile {tab_name}:', e)
+            finally:
+                self.reconciling.discard(key)
+
+        def check(self, worksheet_ids):
+            '''looks up the drive modifiedTime of the spreadsheets not checked in the last
+            config.MODIFIED_CHECK_INTERVAL seconds, all of them in one request'''
+            if self.modified_times is None:
+                return
+            stale = [
+                worksheet_id for worksheet_id in dict.fromkeys(worksheet_ids)
+                if self.cache.modified_time(worksheet_id, config.MODIFIED_CHECK_INTERVAL) is None
+            ]
+            if stale:
+                self.cache.set_modified_times(self.modified_times(stale))
+
+        def revision(self, worksheet_id):
+            '''modifiedTime of the spreadsheet, checked before a read so the read is at least as new'''
+            self.check([worksheet_id])
+            return self.cache.modified_time(worksheet_id, config.MODIFIED_CHECK_INTERVAL)
+
+        def unchanged(self, key):
+            '''an expired cache entry, renewed, if its spreadsheet was not modified since it was read'''
+            revision = self.cache.revision(key)
+            if revision is None or self.revision(key[0]) != revision:
+                return None
+            self.cache.renew(key)
+            return self.cache.get(key)
 
-        def get_data(self, columns, tab_name, worksheet_id, range='A:K'):
+        def refresh(self, tab_name, worksheet_id, df=None, range='A:K', unformatted=False, restore=True):
+            '''brings a tab read earlier up to date by reading only the rows appended since
+
+            the base is the expired cache entry, or df when it still matches the watermark.
+            the header and the last known row are read along with the tail, if either changed
+            the tab was edited above the watermark and is read again in full. edits to rows
+            between the header and the last known row go unseen by that check, so a tab last
+            read in full more than config.DELTA_MAX_AGE seconds ago is read in full as well.
+            there is no delta without a base or when range is not a plain column range like A:K
+            '''
+            key = (worksheet_id, tab_name, range, unformatted)
+            cached = self.cache.get(key)
+            if cached is None:
+                cached = self.unchanged(key)
+            if cached is None and restore:
+                cached = self.restore(key)
+            if cached is not None:
+                self.metrics.hit('sheets.values.get', tab_name)
+                return cached
+            mark = self.cache.mark(key)
+            base = self.cache.get(key, stale=True)
+            if base is None and mark is not None and df is not None and len(df) == mark[0]:
+                base = df
+            columns = re.fullmatch(r'([A-Z]+):([A-Z]+)', range)
+            # snapshots taken before the mark held its read time have 3 items
+            if base is None or mark is None or len(mark) != 4 or not mark[0] or len(base) != mark[0] or columns is None:
+                return self.get_data(None, tab_name, worksheet_id, range, unformatted)
+            rows, header, last, read = mark
+            if time() - read > config.DELTA_MAX_AGE:
+                self.invalidate(worksheet_id, tab_name)
+                return self.get_data(None, tab_name, worksheet_id, range, unformatted)
+            first, end = columns.groups()
+            version = self.cache.version(worksheet_id, tab_name)
+            revision = self.revision(worksheet_id)
             try:
-                values = (self.sheets.spreadsheets().values().get(
+                r = self.execute(self.sheets.spreadsheets().values().batchGet(
                     spreadsheetId=worksheet_id,
-                    range=f"{tab_name}!{range}",
-                    ).execute()
-                )
-            except HTTPError as e:
+                    # the last known row sits on sheet row rows + 1, under the header
+                    ranges=[f"{tab_name}!{first}1:{end}1", f"{tab_name}!{first}{rows + 1}:{end}"],
+                    **self.render_options(unformatted),
+                ), 'sheets.values.batchGet', tab_name)
+            except HttpError as e:
                 print(e)
                 return
-            df = pd.DataFrame(values['values'])
-            df.columns = df.iloc[0]
-            df = df[1:]
-            st.session_state.req_count += 1
-            return df.get(columns) if columns != None else df
-
-        def write_data(self, data, tab_name, worksheet_id, range='A:K'):
-            self.sheets.spreadsheets().values().append(
-                spreadsheetId=worksheet_id,
-                range=f"{tab_name}!{range}",
-                body=dict(values=data),
-                valueInputOption='USER_ENTERED',
-            ).execute()
+            head, tail = [value_range.get('values', []) for value_range in r.get('valueRanges', [])]
+            if head[:1] != [header] or tail[:1] != [last]:
+                self.invalidate(worksheet_id, tab_name)
+                return self.get_data(None, tab_name, worksheet_id, range, unformatted)
+            new = tail[1:]
+            if new:
+                extra = self.to_frame([header] + new, tab_name, unformatted)
+                extra.index += rows
+                base = pd.concat([base, extra])
+                # concatenating categoricals with different categories falls back to object
+                for column in extra.columns:
+                    if isinstance(extra[column].dtype, pd.CategoricalDtype) and base[column].dtype == object:
+                        base[column] = base[column].astype('category')
+            self.store(key, base, version, (rows + len(new), header, tail[-1], read), revision)
+            return base
+
+        def watermark(self, values):
+            '''(data rows, header, last row, read time) of a full read, what refresh() checks the tail against'''
+            if not values:
+                return None
+            return len(values) - 1, values[0], values[-1], time()
+
+        def batch_get(self, tabs, worksheet_id, unformatted=False):
+            '''reads several tabs of one spreadsheet in a single request
+
+            tabs maps tab name to cell range, returns a dict of tab name to dataframe.
+            tabs found in the cache are served from memory and left out of the request.
+            '''
+            frames = {}
+            missing = {}
+            for tab_name, range in tabs.items():
+                key = (worksheet_id, tab_name, range, unformatted)
+                df = self.cache.get(key)
+                if df is None:
+                    df = self.unchanged(key)
+                if df is None:
+                    df = self.restore(key)
+                if df is None:
+                    missing[tab_name] = range
+                else:
+                    self.metrics.hit('sheets.values.batchGet', tab_name)
+                    frames[tab_name] = df
+            if not missing:
+                return frames
+            versions = {tab_name: self.cache.version(worksheet_id, tab_name) for tab_name in missing}
+            revision = self.revision(worksheet_id)
+            ranges = [f"{tab_name}!{range}" for tab_name, range in missing.items()]
+            try:
+                r = self.execute(self.sheets.spreadsheets().values().batchGet(
+                    spreadsheetId=worksheet_id,
+                    ranges=ranges,
+                    **self.render_options(unformatted),
+                ), 'sheets.values.batchGet', worksheet_id)
+            except HttpError as e:
+                print(e)
+                return frames
+            # value ranges come back in the same order they were requested
+            for (tab_name, range), value_range in zip(missing.items(), r.get('valueRanges', [])):
+                df = self.to_frame(value_range.get('values'), tab_name, unformatted)
+                if df is not None:
+                    self.store(
+                        (worksheet_id, tab_name, range, unformatted),
+                        df,
+                        versions[tab_name],
+                        self.watermark(value_range.get('values')),
+                        revision,
+                    )
+                frames[tab_name] = df
+            return frames
+
+        def render_options(self, unformatted):
+            if not unformatted:
+                return {}
+            return {
+                'valueRenderOption': 'UNFORMATTED_VALUE',
+                'dateTimeRenderOption': 'SERIAL_NUMBER',
+            }
+
+        def to_frame(self, values, tab_name=None, unformatted=False):
+            '''turns raw sheet rows into a dataframe using the first row as the header'''
+            if not values:
+                return None
+            header, rows = values[0], values[1:]
+            # the sheets api drops trailing empty cells, pad rows out to the header width
+            width = len(header)
+            rows = [row[:width] + [''] * (width - len(row)) for row in rows]
+            # index 1 is the first row under the header, matching the sheet row offsets
+            df = pd.DataFrame(rows, columns=header, index=range(1, len(rows) + 1))
+            return self.apply_schema(df, config.SCHEMAS.get(tab_name, config.HOURS_SCHEMA), unformatted)
+
+        def apply_schema(self, df, schema, unformatted=False):
+            '''converts the columns named in the schema in place, once, as the tab is read'''
+            for column, kind in schema.items():
+                if column not in df.columns:
+                    continue
+                values = df[column]
+                match kind:
+                    case 'datetime':
+                        if unformatted:
+                            # serial numbers count days from the spreadsheet epoch
+                            df[column] = pd.to_datetime(
+                                pd.to_numeric(values, errors='coerce'), unit='D', origin='1899-12-30'
+                            )
+                        else:
+                            df[column] = pd.to_datetime(values, errors='coerce')
+                    case 'numeric':
+                        df[column] = pd.to_numeric(values, errors='coerce', downcast='float')
+                    case 'category':
+                        df[column] = values.astype('category')
+                    case 'score':
+                        df[column] = pd.Categorical(
+                            values.astype(str).str.strip(),
+                            categories=config.SCORE_LEVELS,
+                            ordered=True,
+                        )
+            return df
+
+        def write_data(self, data, tab_name, worksheet_id, range='A:K', defer=False):
+            '''appends rows to a tab
+
+            deferred rows are queued and appended in the background together with any other
+            rows pending for the same tab, call queue.flush() before reading them back
+            '''
+            if defer:
+                self.queue.put(data, tab_name, worksheet_id, range)
+                return
+            try:
+                r = self.execute(self.sheets.spreadsheets().values().append(
+                    spreadsheetId=worksheet_id,
+                    range=f"{tab_name}!{range}",
+                    body=dict(values=data),
+                    valueInputOption='USER_ENTERED',
+                ), 'sheets.values.append', tab_name, idempotent=False)
+            except Exception:
+                # the rows may or may not have landed
+                self.rows.forget(worksheet_id, tab_name)
+                raise
+            finally:
+                self.invalidate(worksheet_id, tab_name, appended=True)
+            # e.g. 'Members'!A15:D16, the appended rows start on row 15
+            first_row = re.search(r'!([A-Z]+)(\d+)', r.get('updates', {}).get('updatedRange', ''))
+            if first_row is None or first_row.group(1) != 'A':
+                self.rows.forget(worksheet_id, tab_name)
+            else:
+                self.rows.append(worksheet_id, tab_name, int(first_row.group(2)), data)
         
         def batch_update(self, body, worksheet_id):
             r = None
             try:
-                r = self.sheets.spreadsheets().batchUpdate(
+                r = self.execute(self.sheets.spreadsheets().batchUpdate(
                     spreadsheetId=worksheet_id,
                     body=body,
-                ).execute()
-            except HTTPError as e:
+                ), 'sheets.batchUpdate', worksheet_id, idempotent=False)
+                self.register(body.get('requests', []), r.get('replies', []), worksheet_id)
+            except HttpError as e:
                 print(e)
+                # a failed request may have been sent a sheetId the registry had wrong
+                self.registry.forget(worksheet_id)
+                self.rows.forget(worksheet_id)
+            finally:
+                # structural updates can touch any tab in the spreadsheet
+                self.invalidate(worksheet_id)
             return r
 
+        def register(self, requests, replies, worksheet_id):
+            '''applies the tabs and rows our own batchUpdate added and deleted to the registry and row index'''
+            titles = {
+                properties['sheetId']: title
+                for title, properties in (self.registry.get(worksheet_id) or {}).items()
+            }
+            # replies line up with requests, with an empty reply for most request types
+            for request, reply in zip(requests, replies):
+                if 'addSheet' in reply:
+                    self.registry.add(worksheet_id, reply['addSheet']['properties'])
+                elif 'deleteSheet' in request:
+                    self.registry.remove(worksheet_id, request['deleteSheet']['sheetId'])
+                    self.rows.forget(worksheet_id, titles.get(request['deleteSheet']['sheetId']))
+                elif 'deleteDimension' in request and request['deleteDimension']['range']['dimension'] == 'ROWS':
+                    rows = request['deleteDimension']['range']
+                    if rows['sheetId'] in titles:
+                        self.rows.delete(worksheet_id, titles[rows['sheetId']], rows['startIndex'], rows['endIndex'])
+                    else:
+                        self.rows.forget(worksheet_id)
+                else:
+                    # anything else may have moved rows
+                    self.rows.forget(worksheet_id)
+
         def update_values(self, values:list, tab_name, worksheet_id, range):
             values = [values]
             body = {
                 'values': values,
             }
-            request = self.sheets.spreadsheets().values().update(
-                spreadsheetId=worksheet_id,
-                range=range,
-                valueInputOption='USER_ENTERED',
-                body=body,
-            ).execute()
+            try:
+                request = self.execute(self.sheets.spreadsheets().values().update(
+                    spreadsheetId=worksheet_id,
+                    range=range,
+                    valueInputOption='USER_ENTERED',
+                    body=body,
+                ), 'sheets.values.update', tab_name)
+            finally:
+                # the update may have renamed an indexed member
+                self.rows.forget(worksheet_id, tab_name)
+                self.invalidate(worksheet_id, tab_name)
 
 
-    class Drive:
+    class Drive(ApiClient):
         '''functions to interact with the google drive'''
-        def __init__(self, credentials):
-            self.drive = build(
-                serviceName='drive',
-                version='v3',
-                credentials=credentials,
-                cache_discovery=False
-            )
+        def __init__(self, credentials, http_factory=None):
+            super().__init__(credentials, http_factory)
+            self.drive = build_client('drive', 'v3', credentials, http_factory)
+            self.folders = get_folder_index()
 
         def create_folder(self, folder_name, folder_id):
             metadata = {
@@ -144,76 +713,207 @@ class GServices:
             }
             folder = None
             try:
-                folder = self.drive.files().create(
+                folder = self.execute(self.drive.files().create(
                     body=metadata,
                     fields='id',
-                ).execute()
-            except HTTPError as e:
+                ), 'drive.files.create', folder_name, idempotent=False)
+                if folder_id == config.FOLDER_ID:
+                    self.folders.add(folder_name, folder['id'])
+            except HttpError as e:
                 print(e)
             return folder
 
+        def create_folders(self, folder_names, folder_id):
+            '''creates folders through the drive batch endpoint, returns a dict of folder name to id'''
+            created = {}
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    print(exception)
+                    return
+                created[response['name']] = response['id']
+                if folder_id == config.FOLDER_ID:
+                    self.folders.add(response['name'], response['id'])
+
+            # drive accepts at most 100 calls per batch request
+            for i in range(0, len(folder_names), 100):
+                chunk = folder_names[i:i + 100]
+                batch = self.drive.new_batch_http_request(callback=callback)
+                for folder_name in chunk:
+                    batch.add(self.drive.files().create(
+                        body={
+                            'name': folder_name,
+                            'mimeType': 'application/vnd.google-apps.folder',
+                            'parents': [folder_id],
+                        },
+                        fields='id, name',
+                    ))
+                try:
+                    self.timed(
+                        'drive.batch',
+                        folder_id,
+                        lambda: batch.execute(http=self.http()),
+                        cost=len(chunk),
+                        idempotent=False,
+                    )
+                except HttpError as e:
+                    print(e)
+            return created
+
+        def modified_times(self, file_ids):
+            '''returns a dict of file id to drive modifiedTime, several files go out as one batch'''
+            times = {}
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    print(exception)
+                    return
+                times[response['id']] = response['modifiedTime']
+
+            if len(file_ids) == 1:
+                try:
+                    callback(None, self.execute(self.drive.files().get(
+                        fileId=file_ids[0],
+                        fields='id, modifiedTime',
+                    ), 'drive.files.get', file_ids[0]), None)
+                except HttpError as e:
+                    print(e)
+                return times
+            for i in range(0, len(file_ids), 100):
+                chunk = file_ids[i:i + 100]
+                batch = self.drive.new_batch_http_request(callback=callback)
+                for file_id in chunk:
+                    batch.add(self.drive.files().get(fileId=file_id, fields='id, modifiedTime'))
+                try:
+                    self.timed('drive.batch', 'modifiedTime', lambda: batch.execute(http=self.http()), cost=len(chunk))
+                except HttpError as e:
+                    print(e)
+            return times
+
+        def list_files(self, q, target, fields='id, name, mimeType'):
+            '''yields the files matching a query, requesting the next page only when it is reached
+
+            target labels the calls in the metrics, it stays the same from one call to the next
+            where q does not
+            '''
+            page_token = None
+            while True:
+                r = self.execute(self.drive.files().list(
+                    q=q,
+                    fields=f'nextPageToken, files({fields})',
+                    pageSize=1000,
+                    pageToken=page_token,
+                ), 'drive.files.list', target)
+                yield from r.get('files', [])
+                page_token = r.get('nextPageToken')
+                if not page_token:
+                    break
+
+        def refresh_folders(self):
+            '''adds member folders created since the last refresh to the index, the first call lists them all'''
+            # overlap the previous window by a minute to allow for clock skew with drive
+            synced = (datetime.now(timezone.utc) - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S')
+            q = (
+                f'"{config.FOLDER_ID}" in parents '
+                'and mimeType="application/vnd.google-apps.folder" and trashed=false'
+            )
+            if self.folders.synced:
+                q += f' and createdTime > "{self.folders.synced}"'
+            self.folders.update(list(self.list_files(q, config.FOLDER_ID, fields='id, name')), synced)
+
         def get_folder_id(self, folder_name):
-            q = f'mimeType="application/vnd.google-apps.folder" and name="{folder_name}"'
-            file = self.drive.files().list(q=q, fields=f'files(id)').execute()
-            return file['files'][0]['id']
+            folder_id = self.folders.get(folder_name)
+            if folder_id is None:
+                self.refresh_folders()
+                folder_id = self.folders.get(folder_name)
+            if folder_id is None:
+                # not a direct child of the member folder, fall back to a name search
+                q = f'mimeType="application/vnd.google-apps.folder" and name="{folder_name}"'
+                file = self.execute(
+                    self.drive.files().list(q=q, fields=f'files(id)'), 'drive.files.list', folder_name
+                )
+                folder_id = file['files'][0]['id']
+            return folder_id
+
+        def iter_files(self, folder_name, fields='id, name, mimeType'):
+            folder_id = self.get_folder_id(folder_name)
+            return self.list_files(f'"{folder_id}" in parents and trashed=false', folder_name, fields)
 
-        def get_files(self, folder_name):
+        def get_files(self, folder_name, fields='id, name, mimeType'):
             try:
-                folder_id = self.get_folder_id(folder_name)
+                return list(self.iter_files(folder_name, fields))
             except IndexError as e:
                 print(e)
                 return
-            q = f'parents = "{folder_id}"'
-            r = self.drive.files().list(q=q).execute()
-            files = r.get('files')
-            nextPageToken = r.get('nextPageToken')
-            while nextPageToken:
-                r = self.drive.files().list(q=q).execute()
-                files.extend(r.get('files'))
-            return files
 
         def download_file(self, file_id):
             try:
                 request = self.drive.files().get_media(fileId=file_id)
+                request.http = self.http()
                 file = BytesIO()
                 download = MediaIoBaseDownload(file, request)
                 done = False
                 while done is False:
-                    status, done = download.next_chunk()
-            except HTTPError as e:
+                    start = file.tell()
+                    status, done = self.timed(
+                        'drive.files.download', file_id, download.next_chunk, lambda: file.tell() - start
+                    )
+            except HttpError as e:
                 print(e)
                 file = None
 
             return file
 
-        def upload_file(self, file, folder_name):
-            with open(f"temp/{file.name}", "wb") as f:
-                f.write(file.getbuffer())
+        def upload_file(self, file, folder_name, chunk_size=config.UPLOAD_CHUNK_SIZE, progress=None):
+            '''streams an uploaded file into the member's folder in resumable chunks
+
+            file is any binary file object, such as a streamlit UploadedFile.
+            progress is called with the fraction uploaded after every chunk.
+            '''
+            file.seek(0)
             file_metadata = {
                     "name": f"{file.name}",
                     "parents": [self.get_folder_id(folder_name)],
                 }
-            media = MediaFileUpload(f"temp/{file.name}", mimetype="*/*")
-            self.drive.files().create(body=file_metadata, media_body=media, fields="id").execute()
+            media = MediaIoBaseUpload(
+                file,
+                mimetype=getattr(file, 'type', None) or 'application/octet-stream',
+                chunksize=chunk_size,
+                resumable=True,
+            )
+            request = self.drive.files().create(body=file_metadata, media_body=media, fields="id")
+            response = None
+            while response is None:
+                start = request.resumable_progress
+                status, response = self.timed(
+                    'drive.files.upload',
+                    file.name,
+                    lambda: request.next_chunk(http=self.http()),
+                    lambda: request.resumable_progress - start,
+                )
+                if status and progress:
+                    progress(status.progress())
+            if progress:
+                progress(1.0)
+            return response
 
 
     def create_tab(self, user_name, hour_tracker):
         try:
             self.sheets.add_tab(user_name, hour_tracker)
             cell_range = 'A1'
-            values = (
-                ('Date', 'Hours', 'Modality', 'Description', 'Vocab'),
-            )
+            values = (config.HOURS_HEADER,)
             body = {
                 'majorDimension': 'ROWS',
                 'values': values,
             }
-            self.sheets.spreadsheets().values().update(
+            self.sheets.execute(self.sheets.sheets.spreadsheets().values().update(
                 spreadsheetId=hour_tracker,
                 valueInputOption='USER_ENTERED',
                 range=f'{user_name}!{cell_range}',
                 body=body,
-            ).execute()
+            ), 'sheets.values.update', user_name)
+            self.sheets.invalidate(hour_tracker, user_name)
             st.success('created tab')
         except Exception as e:
             print(e)
@@ -255,7 +955,10 @@ class GServices:
         
     def delete_sheet(self, user, hour_tracker):
         worksheet_id = hour_tracker
-        sheet_id = self.get_sheet_id(user['Name'])
+        sheet_id = self.sheets.get_tab_id(user['Name'], worksheet_id)
+        if sheet_id is None:
+            print('no tab to delete for', user['Name'])
+            return
         body = {
             "requests": [
                 {
@@ -265,40 +968,35 @@ class GServices:
                 }
             ]
         }
-        try:
-            r = self.sheets.spreadsheets().batchUpdate(
-                spreadsheetId=worksheet_id, body=body
-            ).execute()
-        except HTTPError as e:
-            print(__name__, e)
+        self.sheets.batch_update(body, worksheet_id)
 
     def delete_info(self, user, hour_tracker, score_tracker):
-        user_data = self.sheets.get_data(columns=None, worksheet_id=score_tracker, tab_name='Main')
-        index = user_data.index[user_data['Name'] == user['Name']].tolist()[0]
+        '''deletes the member's row from the Main tab of the score tracker, returns whether it did'''
+        row = self.sheets.find_row(user['Name'], config.MAIN, score_tracker, range='A:J')
+        sheet_id = self.sheets.get_tab_id(config.MAIN, score_tracker)
+        if row is None or sheet_id is None:
+            print('no score tracker row to delete for', user['Name'])
+            return False
         body = {
             "requests": [
                 {
                     "deleteDimension": {
                         "range": {
-                            "sheetId": hour_tracker,
+                            "sheetId": sheet_id,
                             "dimension": "ROWS",
-                            "startIndex": index,
-                            "endIndex": index + 1,
+                            "startIndex": row - 1,
+                            "endIndex": row,
                         }
                     }
                 }
             ]
         }
-        try:
-            r = self.sheets.spreadsheets().batchUpdate(
-                spreadsheetId=hour_tracker, body=body
-            ).execute()
-        except HTTPError as e:
-            print(e)
+        return self.sheets.batch_update(body, score_tracker) is not None
 
     def remove_member(self, user, hour_tracker, score_tracker):
-        self.delete_sheet(user, hour_tracker)
-        self.delete_info(user, hour_tracker, score_tracker)
+        # the score tracker row goes first, a failure then leaves the member whole
+        if self.delete_info(user, hour_tracker, score_tracker):
+            self.delete_sheet(user, hour_tracker)
 
     def update_member(self, field, name, index, values, hour_id):
         column = ''
@@ -315,16 +1013,21 @@ class GServices:
                 column = ''
         body = {'values': values}
         try:
-            r = self.sheets.spreadsheets().values().update(
+            r = self.sheets.execute(self.sheets.sheets.spreadsheets().values().update(
                 spreadsheetId=hour_id,
                 range=f'{name}!{column}{index}',
                 valueInputOption='USER_ENTERED',
                 body=body,
-            ).execute()
-        except HTTPError as e:
+            ), 'sheets.values.update', name)
+        except HttpError as e:
             print(e)
             st.warning('error')
+            self.sheets.rows.forget(hour_id, name)
             return e
+        finally:
+            self.sheets.invalidate(hour_id, name)
+        if field == 'name' and values and values[0]:
+            self.sheets.rows.rename(hour_id, name, int(index), values[0][0])
 
     def log(self, event, tab_name='Log', worksheet_id='', range='A:D'):
         '''creates an entry in the event log ("Log" tab of the hour tracker)'''
@@ -337,31 +1040,38 @@ class GServices:
                 tab_name=tab_name,
                 worksheet_id=worksheet_id,
                 range=range,
+                defer=True,
             )
         except Exception as e:
             print('could not create log', e)
 
     def update_entries(self, name, worksheet_id):
-        data = self.sheets.get_data(columns=None, tab_name=name, worksheet_id=worksheet_id)
-        st.session_state.current_user['Entries'] = data
+        self.sheets.queue.flush(worksheet_id, name)
+        st.session_state.current_user['Entries'] = self.sheets.refresh(
+            name, worksheet_id, st.session_state.current_user.get('Entries')
+        )
 
     def create_folders_bulk(self):
-        '''tries to create a folder for each member in the group if a folder does not already exist'''
-        count = 0
-        names = st.session_state.members['Name']
-        for name in names:
-            self.create_folder(name)
-            count += 1
-        return count
+        '''creates a folder for each member in the group if a folder does not already exist'''
+        names = st.session_state.members['Name'].tolist()
+        self.drive.refresh_folders()
+        missing = [name for name in names if self.drive.folders.get(name) is None]
+        created = self.drive.create_folders(missing, config.FOLDER_ID)
+        return len(created)
 
     def create_tabs_bulk(self):
-        '''tries to create a tab for each member in the group if a tab does not already exist'''
-        count = 0
-        names = st.session_state.members['Name']
-        for name in names:
-            self.create_tab(name, st.session_state.config['HourTracker'])
-            count += 1
-        return count
+        '''creates a tab for each member in the group if a tab does not already exist'''
+        names = st.session_state.members['Name'].tolist()
+        hour_tracker = st.session_state.config['HourTracker']
+        existing = self.sheets.get_tab_titles(hour_tracker)
+        missing = [name for name in names if name not in existing]
+        if self.sheets.add_tabs(missing, hour_tracker, config.HOURS_HEADER) is None:
+            return 0
+        return len(missing)
+
+    def provision_members(self):
+        '''creates any missing member tabs and folders, returns (tabs created, folders created)'''
+        return self.create_tabs_bulk(), self.create_folders_bulk()
 
 
     class BulkUtils:
@@ -395,3 +1105,11 @@ class GServices:
         def update(self, field, member_name, index, values, hour_tracker_id):
             pass
 
+
+@st.cache_resource
+def get_service():
+    '''google services shared by every session in the process
+
+    the clients hold no session state and run each request on a per-thread connection
+    '''
+    return GServices(config.SERVICE_ACCOUNT, config.SCOPES)
@@ -1,27 +1,168 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import config
+import utils
 from gservices import GServices
 
 
 class Loader:
+    '''loads a session's data on demand
+
+    each dataset is loaded the first time it is asked for, through load() or one of the
+    properties, and kept in session state as before. load_data() only loads what the first
+    page needs, the rest can follow in a background thread. invalidate() has a dataset
+    loaded again, the hours matrix reloads by itself once the tabs it was built from change.
+    '''
+    # datasets the background prefetch loads after the first paint, in order
+    DEFERRED = ('trackers', 'scores', 'subordinates', 'files')
+
     def __init__(self, service, user, group):
         self.service: GServices = service
         self.user = user
         self.group = group
+        self.frames = {}
+        self.loaded = set()
+        self.lock = threading.Lock()
+        self.locks = {}
+        # dataset name -> version of the data it was built from
+        self.versions = {}
+        self.thread = None
+
+    def load_data(self, background=config.PREFETCH):
+        '''loads the config and the user's own entries, optionally the rest in the background'''
+        self.load('config')
+        try:
+            # one drive request tells whether the cached tracker tabs are still current
+            self.service.sheets.check([self.group_config['ScoreTracker'], self.group_config['HourTracker']])
+        except Exception as e:
+            print('could not check trackers:', e)
+        self.load('entries')
+        if background:
+            self.start_prefetch()
+
+    def load(self, name):
+        '''runs load_<name>() the first time the dataset is asked for'''
+        with self.lock:
+            lock = self.locks.setdefault(name, threading.Lock())
+        # a page and the background prefetch asking at once share one fetch
+        with lock:
+            if name not in self.loaded:
+                getattr(self, f'load_{name}')()
+                self.loaded.add(name)
+
+    def invalidate(self, name):
+        '''has the next load() of the dataset read it again'''
+        with self.lock:
+            self.loaded.discard(name)
+
+    def start_prefetch(self):
+        '''loads the deferred datasets in a daemon thread that shares this session's context'''
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(
+            target=lambda: [self.load(name) for name in self.DEFERRED],
+            name='prefetch',
+            daemon=True,
+        )
+        add_script_run_ctx(self.thread, get_script_run_ctx())
+        self.thread.start()
+
+    @property
+    def group_config(self):
+        self.load('config')
+        return st.session_state.config
+
+    @property
+    def score_tracker(self):
+        self.load('trackers')
+        return st.session_state.score_tracker
+
+    @property
+    def scores(self):
+        self.load('scores')
+        return st.session_state.current_user['Scores']
+
+    @property
+    def entries(self):
+        self.load('entries')
+        return st.session_state.current_user['Entries']
+
+    @property
+    def files(self):
+        self.load('files')
+        return st.session_state.current_user['Files']
+
+    @property
+    def subordinates(self):
+        self.load('subordinates')
+        return self.user['Subs']
+
+    @property
+    def hours(self):
+        try:
+            if 'hours' in self.loaded and self.hours_version() != self.versions.get('hours'):
+                self.invalidate('hours')
+        except Exception as e:
+            print('could not check hours:', e)
+        self.load('hours')
+        return st.session_state.hours
 
-    def load_data(self):
-        self.load_config()
-        self.load_trackers()
-        self.load_scores(self.user['Name'])
-        self.load_files()
-        self.load_entries()
-        self.load_subordinates()
+    def hours_version(self):
+        '''changes when the app writes to a member's hour tab or the hour tracker is edited'''
+        tracker = self.group_config['HourTracker']
+        names = st.session_state.members['Name'].tolist()
+        return (
+            tuple(names),
+            tuple(self.service.sheets.cache.version(tracker, name) for name in names),
+            self.service.sheets.revision(tracker),
+        )
+
+    def plan(self):
+        '''lists the score tracker and subordinate tabs, grouped by spreadsheet'''
+        score_tracker = self.group_config['ScoreTracker']
+        hour_tracker = self.group_config['HourTracker']
+        # both trackers may live in the same spreadsheet
+        plan = {score_tracker: {}, hour_tracker: {}}
+        plan[score_tracker][config.MAIN] = 'A:J'
+        for sub in self.get_subordinate_names():
+            plan[hour_tracker][sub] = 'A:K'
+        return {worksheet_id: tabs for worksheet_id, tabs in plan.items() if tabs}
+
+    def load_prefetch(self):
+        '''reads the planned tabs with one batched request per spreadsheet'''
+        try:
+            for worksheet_id, tabs in self.plan().items():
+                frames = self.service.sheets.batch_get(tabs, worksheet_id)
+                for tab_name, df in frames.items():
+                    self.frames[(worksheet_id, tab_name)] = df
+        except Exception as e:
+            # the load functions fall back to reading each tab on its own
+            print('could not prefetch data:', e)
+
+    def get_data(self, tab_name, worksheet_id, range='A:K'):
+        '''returns a prefetched tab, reading it from the sheet if it was not prefetched'''
+        key = (worksheet_id, tab_name)
+        if key in self.frames:
+            return self.frames.pop(key)
+        return self.service.sheets.get_data(
+            columns=None,
+            tab_name=tab_name,
+            worksheet_id=worksheet_id,
+            range=range,
+        )
+
+    def get_subordinate_names(self):
+        return st.session_state.members.query(
+            f'Supervisor == "{self.user["Name"]}"'
+        )['Name'].tolist()
 
     def load_trackers(self):
+        self.load('prefetch')
         try:
-            tracker = st.session_state.config['ScoreTracker']
-            score_tracker = self.service.sheets.get_data(
-                columns=None,
+            tracker = self.group_config['ScoreTracker']
+            score_tracker = self.get_data(
                 tab_name=config.MAIN,
                 worksheet_id=tracker,
                 range='A:J'
@@ -47,38 +188,85 @@ class Loader:
             st.session_state.config = None
 
     def load_subordinates(self):
+        '''loads every subordinate's hour tab concurrently, one failed tab does not stop the rest'''
         self.user['Subs'] = {}
         try:
-            subs = st.session_state.members.query(
-                f'Supervisor == "{self.user["Name"]}"'
-            )['Name'].tolist()
-            for sub in subs:
-                self.user['Subs'].update({
-                    sub: {
-                        'Scores': None,
-                        'Entries': None,
-                    }
-                })
-                scores = st.session_state.score_tracker.query(
-                    f'Name == "{sub}"'
-                ).to_dict('records')[0]
-                self.user['Subs'][sub]['Scores'] = scores
-                entries = self.service.sheets.get_data(
-                    columns=None,
-                    tab_name=sub,
-                    worksheet_id=st.session_state.config['HourTracker'],
-                )
-                self.user['Subs'][sub]['Entries'] = entries
+            subs = self.get_subordinate_names()
+            tracker = self.group_config['HourTracker']
+            # one lookup table instead of a query per subordinate
+            scores = self.score_tracker.drop_duplicates('Name').set_index(
+                'Name', drop=False
+            ).to_dict('index')
         except Exception as e:
             print('could not load subordinates:', e)
+            return
+
+        pending = []
+        for sub in subs:
+            self.user['Subs'][sub] = {
+                'Scores': scores.get(sub),
+                'Entries': None,
+            }
+            if (tracker, sub) in self.frames:
+                self.user['Subs'][sub]['Entries'] = self.frames.pop((tracker, sub))
+            else:
+                pending.append(sub)
+        for sub, entries in self.fetch_tabs(pending, tracker):
+            self.user['Subs'][sub]['Entries'] = entries
+
+    def fetch_tabs(self, tabs, worksheet_id):
+        '''reads tabs concurrently, yielding (tab name, dataframe) pairs as each one arrives
+
+        a tab that fails to load is logged and skipped without stopping the others
+        '''
+        if not tabs:
+            return
+        # worker threads share this script run's context so they can reach session state
+        ctx = get_script_run_ctx()
+        with ThreadPoolExecutor(
+            max_workers=config.MAX_WORKERS,
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+        ) as pool:
+            futures = {
+                pool.submit(
+                    self.service.sheets.get_data,
+                    columns=None,
+                    tab_name=tab_name,
+                    worksheet_id=worksheet_id,
+                ): tab_name
+                for tab_name in tabs
+            }
+            for future in as_completed(futures):
+                tab_name = futures[future]
+                try:
+                    yield tab_name, future.result()
+                except Exception as e:
+                    print(f'could not load {tab_name}:', e)
+
+    def load_hours(self):
+        '''builds the member by month hours matrix of the whole group for the rundown'''
+        try:
+            tracker = self.group_config['HourTracker']
+            names = st.session_state.members['Name'].tolist()
+            # taken before reading so a write that lands during the read changes the key. the
+            # versions only move on the app's own writes, the drive modifiedTime also catches
+            # edits made in the sheet
+            version = self.hours_version()
+            self.versions['hours'] = version
+            entries = self.service.sheets.batch_get({name: 'A:K' for name in names}, tracker)
+            missing = [name for name in names if name not in entries]
+            entries.update(self.fetch_tabs(missing, tracker))
+            st.session_state.hours = utils.monthly_hours(entries, tracker, tuple(names), version[1:])
+        except Exception as e:
+            print('could not load hours:', e)
+            st.session_state.hours = None
 
     def load_entries(self):
         try:
-            tracker = st.session_state.config['HourTracker']
-            st.session_state.current_user['Entries'] = self.service.sheets.get_data(
-                columns=None,
-                tab_name=self.user['Name'],
-                worksheet_id=tracker,
+            tracker = self.group_config['HourTracker']
+            # reads only the rows appended since this tab was last read in the process
+            st.session_state.current_user['Entries'] = self.service.sheets.refresh(
+                self.user['Name'], tracker
             )
         except Exception as e:
             print('could not load entries:', e)
@@ -93,9 +281,10 @@ class Loader:
             print('could not load files:', e)
             st.session_state.current_user['Files'] = None
 
-    def load_scores(self, name):
+    def load_scores(self, name=None):
+        name = name or self.user['Name']
         try:
-            user_scores = st.session_state.score_tracker.query(
+            user_scores = self.score_tracker.query(
                 f'Name == "{name}"'
             ).to_dict('records')[0]
             user_scores.pop('Name')
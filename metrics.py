@@ -0,0 +1,138 @@
+import json
+import threading
+from bisect import bisect_left
+import pandas as pd
+import streamlit as st
+
+# upper bounds of the latency histogram buckets in milliseconds, the last bucket is open ended
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Metrics:
+    '''process-wide call counts, payload sizes and latency histograms of google api calls
+
+    calls are recorded per operation (e.g. sheets.values.get) and per target, which is
+    the tab or spreadsheet the call touched
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.targets = {}
+        self.gauges = {}
+
+    def new_stats(self):
+        return {
+            'calls': 0,
+            'errors': 0,
+            'retries': 0,
+            'cache_hits': 0,
+            'bytes': 0,
+            'latency_ms': 0.0,
+            'max_ms': 0.0,
+            'histogram': [0] * (len(BUCKETS) + 1),
+        }
+
+    def record(self, operation, target, latency, payload=0, retries=0, error=False):
+        '''records one api call, latency is in seconds and payload in response bytes'''
+        ms = latency * 1000
+        with self.lock:
+            for stats in (
+                self.operations.setdefault(operation, self.new_stats()),
+                self.targets.setdefault((operation, target), self.new_stats()),
+            ):
+                stats['calls'] += 1
+                stats['errors'] += int(error)
+                stats['retries'] += retries
+                stats['bytes'] += payload
+                stats['latency_ms'] += ms
+                stats['max_ms'] = max(stats['max_ms'], ms)
+                stats['histogram'][bisect_left(BUCKETS, ms)] += 1
+
+    def hit(self, operation, target):
+        '''records a read served from the cache instead of the api'''
+        with self.lock:
+            self.operations.setdefault(operation, self.new_stats())['cache_hits'] += 1
+            self.targets.setdefault((operation, target), self.new_stats())['cache_hits'] += 1
+
+    def gauge(self, name, value):
+        '''records the latest value of a level, such as a queue depth, and its peak'''
+        with self.lock:
+            gauge = self.gauges.setdefault(name, {'value': 0, 'max': 0})
+            gauge['value'] = value
+            gauge['max'] = max(gauge['max'], value)
+
+    def report(self):
+        '''a json serializable snapshot of every operation and target'''
+        with self.lock:
+            return {
+                'buckets_ms': list(BUCKETS),
+                'operations': {
+                    operation: dict(stats, histogram=list(stats['histogram']))
+                    for operation, stats in self.operations.items()
+                },
+                'targets': [
+                    dict(stats, operation=operation, target=target, histogram=list(stats['histogram']))
+                    for (operation, target), stats in self.targets.items()
+                ],
+                'gauges': {name: dict(gauge) for name, gauge in self.gauges.items()},
+            }
+
+    def to_json(self, indent=2):
+        return json.dumps(self.report(), indent=indent)
+
+    def reset(self):
+        with self.lock:
+            self.operations.clear()
+            self.targets.clear()
+            self.gauges.clear()
+
+
+@st.cache_resource
+def get_metrics():
+    '''metrics shared by every session in the process'''
+    return Metrics()
+
+
+def percentile(histogram, fraction):
+    '''upper bucket bound under which the given fraction of calls finished'''
+    total = sum(histogram)
+    if not total:
+        return 0
+    seen = 0
+    for bound, count in zip(list(BUCKETS) + [float('inf')], histogram):
+        seen += count
+        if seen >= total * fraction:
+            return bound
+    return float('inf')
+
+
+def summary(report):
+    '''one row per operation with call counts, bytes and latency percentiles'''
+    rows = []
+    for operation, stats in report['operations'].items():
+        calls = stats['calls']
+        rows.append({
+            'operation': operation,
+            'calls': calls,
+            'cache hits': stats['cache_hits'],
+            'errors': stats['errors'],
+            'retries': stats['retries'],
+            'KiB': round(stats['bytes'] / 1024, 1),
+            'mean ms': round(stats['latency_ms'] / calls, 1) if calls else 0,
+            'p50 ms': percentile(stats['histogram'], 0.5),
+            'p95 ms': percentile(stats['histogram'], 0.95),
+            'max ms': round(stats['max_ms'], 1),
+        })
+    return pd.DataFrame(rows)
+
+
+def render(metrics):
+    '''shows the metrics report on the dev page'''
+    report = metrics.report()
+    st.subheader('API metrics')
+    st.dataframe(summary(report), use_container_width=True)
+    if report['gauges']:
+        st.dataframe(pd.DataFrame(report['gauges']).T)
+    with st.expander('Calls by target'):
+        st.dataframe(pd.DataFrame(report['targets']).drop(columns=['histogram'], errors='ignore'))
+    st.download_button('Download metrics', metrics.to_json(), file_name='metrics.json', mime='application/json')
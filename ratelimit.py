@@ -0,0 +1,66 @@
+import random
+import threading
+from time import monotonic, sleep
+from googleapiclient.errors import HttpError
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    '''token bucket shared by every session, allows rate calls per period seconds
+
+    callers block in acquire() until a token is free, waiting counts how many are queued
+    '''
+    def __init__(self, rate, period=60):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / period
+        self.updated = monotonic()
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        '''takes tokens from the bucket, returns the number of callers that were queued'''
+        tokens = min(tokens, self.capacity)
+        with self.lock:
+            self.waiting += 1
+            depth = self.waiting
+        try:
+            while True:
+                with self.lock:
+                    now = monotonic()
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                    self.updated = now
+                    if self.tokens >= tokens:
+                        self.tokens -= tokens
+                        return depth
+                    wait = (tokens - self.tokens) / self.fill_rate
+                sleep(wait)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+
+def is_retryable(error, idempotent=True):
+    '''whether a failed call may be sent again
+
+    rate limit responses were never processed so they are always safe to retry, server
+    errors and dropped connections only for calls that can be repeated without side effects
+    '''
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 429:
+            return True
+        if status == 403 and b'ratelimitexceeded' in (error.content or b'').lower():
+            return True
+        return idempotent and status in RETRYABLE_STATUSES
+    return idempotent and isinstance(error, (ConnectionError, TimeoutError))
+
+
+def backoff(attempt, error, base, cap):
+    '''seconds to wait before the next attempt, full jitter exponential backoff'''
+    if isinstance(error, HttpError):
+        retry_after = error.resp.get('retry-after')
+        if retry_after and retry_after.isdigit():
+            return min(cap, float(retry_after))
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import pyarrow as pa
+
+
+def digest(value):
+    return hashlib.sha1(repr(value).encode()).hexdigest()[:16]
+
+
+class SnapshotStore:
+    '''arrow ipc files of tab reads that outlive the process
+
+    a snapshot holds the typed dataframe of one tab cache key together with the drive
+    modifiedTime and watermark of the read that produced it and the time it was fetched.
+    files are laid out as <directory>/<spreadsheet>/<tab>-<range>.arrow and are written by a
+    background thread, readers map them into memory.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot')
+
+    def path(self, key):
+        worksheet_id, tab_name = key[:2]
+        return os.path.join(self.directory, digest(worksheet_id), f'{digest(tab_name)}-{digest(key[2:])}.arrow')
+
+    def save(self, key, df, revision, mark):
+        '''queues a snapshot of df, replacing the previous one of key'''
+        metadata = {
+            'key': list(key),
+            'revision': revision,
+            'mark': mark,
+            'fetched': datetime.now(timezone.utc).isoformat(),
+        }
+        self.writer.submit(self.write, self.path(key), df, metadata)
+
+    def write(self, path, df, metadata):
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=True)
+            table = table.replace_schema_metadata({
+                **(table.schema.metadata or {}),
+                b'snapshot': json.dumps(metadata).encode(),
+            })
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # readers never see a half written file
+            temp = f'{path}.{os.getpid()}.tmp'
+            with pa.OSFile(temp, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(temp, path)
+        except Exception as e:
+            print('could not write snapshot:', e)
+
+    def load(self, key):
+        '''returns (dataframe, metadata) of the snapshot of key, or None'''
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+            metadata = json.loads(table.schema.metadata[b'snapshot'])
+            return table.to_pandas(), metadata
+        except Exception as e:
+            print('could not read snapshot:', e)
+            return None
+
+    def discard(self, worksheet_id, tab_name=None):
+        '''removes the snapshots of a tab, or of the whole spreadsheet when no tab is given'''
+        # queued behind pending writes so an earlier save cannot bring a snapshot back
+        self.writer.submit(self.remove, worksheet_id, tab_name)
+
+    def purge(self, tab_names):
+        '''removes the snapshots of the named tabs from every spreadsheet'''
+        if not os.path.isdir(self.directory):
+            return
+        prefixes = tuple(f'{digest(tab_name)}-' for tab_name in tab_names)
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if prefixes and name.startswith(prefixes):
+                    os.remove(os.path.join(root, name))
+
+    def remove(self, worksheet_id, tab_name):
+        directory = os.path.join(self.directory, digest(worksheet_id))
+        if tab_name is None:
+            shutil.rmtree(directory, ignore_errors=True)
+            return
+        if not os.path.isdir(directory):
+            return
+        prefix = f'{digest(tab_name)}-'
+        for name in os.listdir(directory):
+            if name.startswith(prefix):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,186 @@
+import hashlib
+import json
+from datetime import datetime
+import pandas as pd
+import config
+from db import User, Group, LanguageHour, Score, SyncState
+from gservices import GServices
+
+
+class SheetSync:
+    '''mirrors a group's sheets into the database models
+
+    keyed tabs (Members and the score tracker) are upserted by name, and only rows
+    whose content hash changed since the last run are written. names gone from a keyed
+    tab are removed, a member with their user, scores and hours. hour tabs are append only,
+    so each keeps a row high-water mark and a digest of the rows under it. a run inserts
+    just the rows past the mark, and rebuilds a tab only when rows under the mark were
+    edited or removed.
+    '''
+    def __init__(self, service, session):
+        self.service: GServices = service
+        self.session = session
+
+    def run(self, group):
+        '''syncs one group and commits, returns the number of rows written'''
+        count = 0
+        try:
+            info = self.service.sheets.get_data(columns=None, tab_name=config.INFO, worksheet_id=config.MASTER_ID)
+            group_config = info.query(f'Group == "{group}"').to_dict('records')[0]
+            group_row = self.session.query(Group).filter_by(name=group).first()
+            if group_row is None:
+                group_row = Group(name=group)
+                self.session.add(group_row)
+                self.session.flush()
+                count += 1
+
+            members = self.service.sheets.get_data(
+                columns=None,
+                tab_name=config.MEMBERS,
+                worksheet_id=config.MASTER_ID,
+                range='A:I',
+            )
+            members = members[members['Group'] == group].drop(columns=['Password'], errors='ignore')
+            hour_tracker = group_config['HourTracker']
+            # groups share the Members tab, each keeps the hashes of its own members
+            count += self.sync_keyed(
+                members,
+                config.MASTER_ID,
+                f'{config.MEMBERS} {group}',
+                lambda row: self.sync_user(row, group_row),
+                lambda name: self.remove_user(name, group_row, hour_tracker),
+            )
+            users = {user.name: user for user in group_row.users}
+
+            scores = self.service.sheets.get_data(
+                columns=None,
+                tab_name=config.MAIN,
+                worksheet_id=group_config['ScoreTracker'],
+                range='A:J',
+            )
+            scores = scores[scores['Name'].isin(users)]
+            count += self.sync_keyed(
+                scores,
+                group_config['ScoreTracker'],
+                f'{config.MAIN} {group}',
+                lambda row: self.sync_score(row, users),
+                lambda name: self.remove_scores(name, users),
+            )
+
+            tabs = self.service.sheets.batch_get({name: 'A:K' for name in users}, hour_tracker)
+            for name, user in users.items():
+                if name not in tabs:
+                    tabs[name] = self.service.sheets.get_data(columns=None, tab_name=name, worksheet_id=hour_tracker)
+                if tabs[name] is not None:
+                    count += self.sync_hours(tabs[name], hour_tracker, user)
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            print('could not sync group:', e)
+        return count
+
+    def state(self, worksheet_id, tab):
+        state = self.session.query(SyncState).filter_by(worksheet_id=worksheet_id, tab=tab).first()
+        if state is None:
+            state = SyncState(worksheet_id=worksheet_id, tab=tab, rows=0)
+            self.session.add(state)
+        return state
+
+    def row_hashes(self, df):
+        return pd.util.hash_pandas_object(df, index=False).astype(str)
+
+    def digest(self, hashes):
+        return hashlib.sha256(','.join(hashes).encode()).hexdigest()
+
+    def sync_keyed(self, df, worksheet_id, tab, upsert, remove):
+        '''upserts the rows whose hash changed since the last run, keyed by Name, and removes
+        the names that were in the last run but are gone now'''
+        state = self.state(worksheet_id, tab)
+        known = json.loads(state.row_hashes) if state.row_hashes else {}
+        hashes = dict(zip(df['Name'], self.row_hashes(df)))
+        count = 0
+        for row in df.to_dict('records'):
+            if known.get(row['Name']) != hashes[row['Name']]:
+                upsert(row)
+                count += 1
+        # after the upserts, a renamed member is found under their new name
+        for name in known.keys() - hashes.keys():
+            remove(name)
+            count += 1
+        state.row_hashes = json.dumps(hashes)
+        state.rows = len(df)
+        state.synced = datetime.utcnow()
+        self.session.flush()
+        return count
+
+    def sync_user(self, row, group):
+        user = self.session.query(User).filter_by(username=row['Username']).first()
+        if user is None:
+            user = User(username=row['Username'])
+            self.session.add(user)
+        user.name = row['Name']
+        user.is_admin = 'admin' in str(row.get('Flags', ''))
+        user.email = row.get('Email') or user.email
+        user.group_id = group.id
+
+    def remove_user(self, name, group, hour_tracker):
+        '''deletes a member who left the group along with their scores and hours'''
+        self.session.query(SyncState).filter_by(worksheet_id=hour_tracker, tab=name).delete()
+        for user in self.session.query(User).filter_by(group_id=group.id, name=name).all():
+            self.session.query(LanguageHour).filter_by(user_id=user.id).delete()
+            self.session.query(Score).filter_by(user_id=user.id).delete()
+            self.session.delete(user)
+        self.session.flush()
+        self.session.expire(group, ['users'])
+
+    def remove_scores(self, name, users):
+        '''deletes the scores of a member no longer in the score tracker'''
+        user = users.get(name)
+        if user is not None:
+            self.session.query(Score).filter_by(user_id=user.id).delete()
+
+    def sync_score(self, row, users):
+        user = users[row['Name']]
+        date = self.to_date(row.get(config.DLTP_DATE))
+        score = self.session.query(Score).filter_by(user_id=user.id, date=date).first()
+        if score is None:
+            score = Score(user_id=user.id, date=date)
+            self.session.add(score)
+        score.listening = self.to_str(row.get(config.CLANG_L))
+        score.reading = self.to_str(row.get(config.CLANG_R))
+
+    def sync_hours(self, df, worksheet_id, user):
+        '''inserts the rows past the high-water mark, rebuilding the tab if older rows changed'''
+        state = self.state(worksheet_id, user.name)
+        hashes = self.row_hashes(df).tolist()
+        mark = state.rows or 0
+        # a tab synced for the first time, as after a rename, replaces whatever the user had
+        if not mark or mark > len(df) or self.digest(hashes[:mark]) != state.digest:
+            self.session.query(LanguageHour).filter_by(user_id=user.id).delete()
+            mark = 0
+        rows = df.iloc[mark:].to_dict('records')
+        self.session.add_all([
+            LanguageHour(
+                date=self.to_date(row.get('Date')),
+                hours=self.to_int(row.get('Hours')),
+                description=self.to_str(row.get('Description')),
+                modalities=[m.strip() for m in self.to_str(row.get('Modality')).split(',') if m.strip()],
+                user_id=user.id,
+            )
+            for row in rows
+        ])
+        state.rows = len(df)
+        state.digest = self.digest(hashes)
+        state.synced = datetime.utcnow()
+        return len(rows)
+
+    def to_date(self, value):
+        value = pd.to_datetime(value, errors='coerce')
+        return None if pd.isnull(value) else value.date()
+
+    def to_int(self, value):
+        value = pd.to_numeric(value, errors='coerce')
+        return 0 if pd.isnull(value) else int(value)
+
+    def to_str(self, value):
+        return '' if pd.isnull(value) else str(value)
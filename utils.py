@@ -1,13 +1,24 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import pytz
+import multiprocessing
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
 from time import time
 from datetime import datetime
+from zipfile import ZipFile, ZIP_DEFLATED
 import config
+from metrics import get_metrics
+import xlsxwriter
 from PyPDF2 import PdfWriter, PdfReader
 from PyPDF2.generic import BooleanObject, NameObject, IndirectObject
-import PyPDF2.generic as pdfgen
 
 def initialize_session_state_variables(vars):
     '''helper function to initialize streamlit session state variables'''
@@ -18,131 +29,212 @@ def initialize_session_state_variables(vars):
 def to_excel(df):
     '''convert dataframe into downloadable excel file'''
     output = BytesIO()
-    writer = pd.ExcelWriter(output, engine="xlsxwriter")
-    df.to_excel(writer, index=False, sheet_name="MyHistory")
-    writer.save()
+    # closing the writer saves the workbook, ExcelWriter.save() is gone from newer pandas
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        df.to_excel(writer, index=False, sheet_name="MyHistory")
     return output.getvalue()
 
+def sheet_rows(df, chunk_size=1000):
+    '''yields the header and then every row of df as plain python values, missing ones as None'''
+    yield list(df.columns)
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        yield from chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None)
+
+def sheet_name(name, used):
+    '''a unique worksheet name excel accepts, at most 31 characters without []:*?/\\'''
+    base = re.sub(r'[\[\]:*?/\\]', '_', str(name))[:31] or 'Sheet'
+    name, i = base, 1
+    while name.lower() in used:
+        suffix = f' ({i})'
+        name, i = base[:31 - len(suffix)] + suffix, i + 1
+    used.add(name.lower())
+    return name
+
+def history_summary(name, data):
+    '''one summary sheet row of a member's hour tab'''
+    if not isinstance(data, pd.DataFrame) or data.empty:
+        return [name, 0, 0, None, None]
+    entries = parse_entries(data)
+    dates = entries['Date'].dropna()
+    return [
+        name,
+        len(entries),
+        float(entries['Hours'].sum()),
+        dates.min().to_pydatetime() if not dates.empty else None,
+        dates.max().to_pydatetime() if not dates.empty else None,
+    ]
+
+def group_to_excel(entries: dict):
+    '''exports every member's hour tab to its own worksheet behind a summary sheet
+
+    entries maps member name to hour tab. xlsxwriter runs in constant_memory mode, rows are
+    fed from generators and flushed to disk as they are written, and the workbook goes to a
+    file that moves from memory to disk past config.SPOOL_MAX_SIZE. returns the file
+    positioned at the start.
+    '''
+    output = SpooledTemporaryFile(max_size=config.SPOOL_MAX_SIZE)
+    workbook = xlsxwriter.Workbook(output, {
+        'constant_memory': True,
+        'default_date_format': config.EXCEL_DATE_FORMAT,
+    })
+    header = workbook.add_format({'bold': True})
+    used = {'summary'}
+    # constant_memory needs rows in order, the summary is the first sheet but is written last
+    summary = workbook.add_worksheet('Summary')
+    rows = [['Name', 'Entries', 'Total Hours', 'First Entry', 'Last Entry']]
+    for name, data in entries.items():
+        rows.append(history_summary(name, data))
+        if not isinstance(data, pd.DataFrame):
+            continue
+        worksheet = workbook.add_worksheet(sheet_name(name, used))
+        for row, values in enumerate(sheet_rows(data)):
+            worksheet.write_row(row, 0, values, header if row == 0 else None)
+    for row, values in enumerate(rows):
+        summary.write_row(row, 0, values, header if row == 0 else None)
+    workbook.close()
+    output.seek(0)
+    return output
+
 def timeit(func):
-    '''time how long a function takes to execute'''
+    '''time how long a function takes to execute, recorded in the dev page metrics as timeit.<name>'''
     def wrapper(*args, **kwargs):
         start = time()
         output = func(*args, **kwargs)
         stop = time()
         print(func.__name__, "executed in", int((stop - start) * 1000), "ms")
+        get_metrics().record(f'timeit.{func.__name__}', '', stop - start)
         return output
     return wrapper
 
-def calculate_hours_done_this_month(data, month=datetime.now().date().month):
+def parse_entries(data):
+    '''returns the Date and Hours columns of an hour tab as datetime64 and numeric columns'''
+    return pd.DataFrame({
+        'Date': pd.to_datetime(data['Date'], errors='coerce'),
+        'Hours': pd.to_numeric(data['Hours'], errors='coerce').fillna(0),
+    })
+
+def build_hours_matrix(entries: dict) -> pd.DataFrame:
+    '''hours per member (rows) and year-month (columns) from a dict of member name to hour tab'''
+    frames = [
+        parse_entries(data).assign(Name=name)
+        for name, data in entries.items()
+        if isinstance(data, pd.DataFrame) and not data.empty
+    ]
+    if not frames:
+        return pd.DataFrame(index=pd.Index(list(entries), name='Name'))
+    data = pd.concat(frames, ignore_index=True).dropna(subset=['Date'])
+    matrix = data.groupby(
+        ['Name', data['Date'].dt.to_period('M')]
+    )['Hours'].sum().unstack(fill_value=0)
+    # members without any entries still get a row of zeros
+    return matrix.reindex(list(entries), fill_value=0)
+
+@st.cache_data(ttl=config.CACHE_TTL, max_entries=32)
+def monthly_hours(_entries: dict, tracker, names: tuple, version) -> pd.DataFrame:
+    '''cached build_hours_matrix of the named members' tabs in the tracker spreadsheet
+
+    _entries is not hashed, tracker and names identify the group in the cache key and
+    version must change whenever any of the hour tabs change
+    '''
+    return build_hours_matrix(_entries)
+
+def month_totals(matrix: pd.DataFrame, year: int, month: int) -> pd.Series:
+    '''hours done by every member during the month'''
+    period = pd.Period(year=year, month=month, freq='M')
+    if period not in matrix.columns:
+        return pd.Series(0, index=matrix.index)
+    return matrix[period]
+
+def hours_for_month(matrix: pd.DataFrame, name, year: int, month: int):
+    '''hours one member did during the month'''
+    try:
+        return matrix.at[name, pd.Period(year=year, month=month, freq='M')]
+    except KeyError:
+        return 0
+
+def calculate_hours_done_this_month(data, month=None):
     # if member has no entries
     if not isinstance(data, pd.core.frame.DataFrame):
         return 0
     if data is None:
         return 0
+    if month is None:
+        month = datetime.now().date().month
     # get sum of hours done during the month
-    hours = sum([int(row[1]) for row in data.values if int(row[0][5:7]) == month])
-    return hours
+    data = parse_entries(data)
+    return data['Hours'][data['Date'].dt.month == month].sum()
+
+def score_values(levels: pd.Series) -> pd.Series:
+    '''maps score levels to numbers, a plus adds a half: "2+" -> 2.5'''
+    values = {level: i / 2 for i, level in enumerate(config.SCORE_LEVELS)}
+    return levels.astype(str).str.strip().map(values)
+
+def add_months(dates: pd.Series, months: pd.Series) -> pd.Series:
+    '''adds a per-row number of calendar months, one vectorized shift per distinct value'''
+    result = dates.copy()
+    for n in months.unique():
+        mask = months == n
+        result[mask] = dates[mask] + pd.DateOffset(months=int(n))
+    return result
+
+def calculate_compliance(scores: pd.DataFrame) -> pd.DataFrame:
+    '''required monthly hours and next DLPT and SLTE due dates for every row of the score tracker'''
+    listen = score_values(scores[config.CLANG_L])
+    read = score_values(scores[config.CLANG_R])
+
+    # either score below 2, both 3 or above, otherwise by combined score
+    low = (listen < 2) | (read < 2)
+    high = (listen >= 3) & (read >= 3)
+    total = listen + read
+    hours = np.select(
+        [low, high, total >= 5.5, total >= 5.0, total >= 4.5, total >= 4.0],
+        [12, 0, 2, 4, 6, 8],
+        default=0,
+    )
+
+    # due date ranges use the whole score level
+    listen, read = np.floor(listen), np.floor(read)
+    levels = [
+        (listen >= 3) & (read >= 3),
+        (listen >= 2) & (read >= 2),
+        (listen < 2) & (read < 2),
+    ]
+    dlpt_months = pd.Series(np.select(levels, [24, 12, 12], default=0), index=scores.index)
+    slte_months = pd.Series(np.select(
+        levels,
+        [config.SLTE_RANGE['3'], config.SLTE_RANGE['2'], config.SLTE_RANGE['1']],
+        default=0,
+    ), index=scores.index)
+
+    last_dlpt = pd.to_datetime(scores[config.DLTP_DATE], format='%m/%d/%Y', errors='coerce')
+    last_slte = pd.to_datetime(scores[config.SLTE_DATE], format='%m/%d/%Y', errors='coerce')
+
+    return pd.DataFrame({
+        'Hours Required': hours,
+        'DLPT Due': add_months(last_dlpt, dlpt_months),
+        'SLTE Due': add_months(last_slte, slte_months),
+    }, index=scores.index)
 
 def calculate_hours_required(data: dict) -> int:
     if not data or data is None:
         return 0
-
-    def _eval(_string: str):  
-        value = 0.0
-        if '+' in _string:
-            value += 0.5
-            _string = _string.strip('+')
-            value += float(_string)
-        else:
-            value = float(_string)
-        return value
-
-    BAD = ['1+', '1', '0+', '0']
-    OKAY = ['2', '2+']
-    GOOD = ['3', '3+', '4']
-
-    listen = data[config.CLANG_L]
-    read = data[config.CLANG_R]
-
-    # if either score is below 2
-    if listen in BAD or read in BAD:
-        return 12
-        
-    # if score is 3+
-    if listen in GOOD and read in GOOD:
-        return 0
-
-    # if score is 2
-    else:
-        table ={
-            5.5: 2,
-            5.0: 4,
-            4.5: 6,
-            4.0: 8
-        }
-        l_value = _eval(listen)
-        r_value = _eval(read)
-        return table[l_value + r_value]
+    return int(calculate_compliance(pd.DataFrame([data]))['Hours Required'].iloc[0])
 
 def get_user_info_index(name):
     '''get the index of the row where user data is located'''
-    df = st.session_state.members
-    index = df.loc[df['Name'] ==  name].index[0]
-    return index + 1
+    return st.session_state.service.sheets.find_row(name, config.MEMBERS, config.MASTER_ID, range='A:I')
 
 def check_due_dates(scores: dict) -> tuple:
     '''return range as timestamp tuple (DLPT due date, SLTE due date)'''
-    str_format = '%m/%d/%Y'
-    one_year = 31536000.0
-    one_month = 2628000.0
-
-    listen = scores[config.CLANG_L].strip("+")
-    read = scores[config.CLANG_R].strip("+")
-
-    if scores[config.DLTP_DATE] != '':
-        last_dlpt = datetime.strptime(scores[config.DLTP_DATE], str_format).timestamp()
-    else:
-        last_dlpt = -1
-
-    if scores[config.SLTE_DATE] != '':
-        last_slte = datetime.strptime(scores[config.SLTE_DATE], str_format).timestamp()
-    else:
-        last_slte = -1
-
-    def calculate_next_dlpt_date(last_date):
-        '''returns next due date as timestamp'''
-        _next_dlpt = last_date
-        if last_date == -1:
-            return -1
-        if int(listen) >= 3 and int(read) >= 3:
-            _next_dlpt = last_date + one_year * 2
-        
-        elif int(listen) >= 2 and int(read) >= 2:
-            _next_dlpt = last_date + one_year
-
-        elif int(listen) < 2 and int(read) < 2:
-            _next_dlpt = last_date + one_year
-        return _next_dlpt
-    
-    def calculate_next_slte_date(last_date):
-        '''returns next due date as timestamp'''
-        _next_slte = last_date
-        if last_date == -1:
-            return -1
-        if int(listen) >= 3 and int(read) >= 3:
-            _next_slte = last_date + one_month * config.SLTE_RANGE['3']
-        
-        elif int(listen) >= 2 and int(read) >= 2:
-            _next_slte = last_date + one_month * config.SLTE_RANGE['2']
+    due = calculate_compliance(pd.DataFrame([scores])).iloc[0]
 
-        elif int(listen) < 2 and int(read) < 2:
-            _next_slte = last_date + one_month * config.SLTE_RANGE['1']
-        return _next_slte
+    def to_timestamp(value):
+        if pd.isnull(value):
+            return -1
+        return value.to_pydatetime().timestamp()
 
-    next_dlpt = calculate_next_dlpt_date(last_dlpt)
-    next_slte = calculate_next_slte_date(last_slte)
-    
-    return (next_dlpt, next_slte)
+    return (to_timestamp(due['DLPT Due']), to_timestamp(due['SLTE Due']))
 
 def to_date(bignumber):
     '''convert timestamp to EST date'''
@@ -167,20 +259,27 @@ def set_need_appearances_writer(writer: PdfWriter):
         print('set_need_appearances_writer() catch : ', repr(e))
         return writer
 
+@lru_cache(maxsize=None)
+def load_template(path='template.pdf'):
+    '''parsed form template and its field names, read once per process'''
+    reader = PdfReader(path)
+    return reader, frozenset(reader.get_fields() or {})
+
+template_lock = threading.Lock()
+
 def create_pdf(data):
-    reader = PdfReader('template.pdf')
-    page = reader.pages[0]
+    reader, fields = load_template()
 
     writer = PdfWriter()
     set_need_appearances_writer(writer)
 
-    fields = reader.get_fields()
-    key = pdfgen.NameObject('/V')
-    value = pdfgen.create_string_object('TESTVALUE')
-    fields['Member Name'][key] = value
-
-    writer.update_page_form_field_values(page, fields=data)
-    writer.add_page(page)
+    # add_page clones the template page, sessions share the reader so only one clones at a time
+    with template_lock:
+        page = writer.add_page(reader.pages[0])
+    writer.update_page_form_field_values(
+        page,
+        fields={key: value for key, value in data.items() if key in fields},
+    )
 
     # Save the output PDF file to a buffer
     output_buffer = BytesIO()
@@ -189,3 +288,34 @@ def create_pdf(data):
 
     return output_buffer
 
+def fill_form(form):
+    '''process pool worker, returns (file name, pdf bytes)'''
+    name, data = form
+    return name, create_pdf(data).getvalue()
+
+def create_pdfs(forms, workers=None):
+    '''fills a form for every (file name, data) pair on a process pool and streams them into a zip
+
+    at most two pdfs per worker are in flight, the zip is spooled to disk once it outgrows
+    config.SPOOL_MAX_SIZE. returns the zip file positioned at the start. workers are spawned
+    rather than forked, a fork of the threaded server could inherit template_lock held by
+    another session's thread and hang.
+    '''
+    workers = workers or os.cpu_count() or 1
+    window = 2 * workers
+    output = SpooledTemporaryFile(max_size=config.SPOOL_MAX_SIZE)
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=load_template,
+    )
+    with pool, ZipFile(output, 'w', ZIP_DEFLATED) as archive:
+        pending = deque()
+        for form in forms:
+            pending.append(pool.submit(fill_form, form))
+            if len(pending) >= window:
+                archive.writestr(*pending.popleft().result())
+        while pending:
+            archive.writestr(*pending.popleft().result())
+    output.seek(0)
+    return output
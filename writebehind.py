@@ -0,0 +1,93 @@
+import atexit
+import threading
+from ratelimit import is_retryable
+
+
+class WriteBehindQueue:
+    '''coalesces appends per (spreadsheet, tab, range) and writes them from a background thread
+
+    pending rows for a tab go out as a single append once max_rows are waiting, every
+    interval seconds, on flush() and at exit. put() blocks while max_pending rows are
+    buffered so a stalled api cannot grow the queue without bound. rows whose append
+    was rate limited, and so never written, go back to the front of their tab's queue to
+    be retried with the next flush, as many of them as max_pending leaves room for. rows
+    that failed any other way are dropped, an append is not safe to repeat.
+    '''
+    def __init__(self, append, max_rows, interval, max_pending):
+        self.append = append
+        self.max_rows = max_rows
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.count = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        # only one flush writes at a time so rows for a tab keep their order
+        self.flush_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, rows, tab_name, worksheet_id, range):
+        with self.cond:
+            while self.count >= self.max_pending and not self.closed:
+                self.cond.wait()
+            key = (worksheet_id, tab_name, range)
+            self.pending.setdefault(key, []).extend(rows)
+            self.count += len(rows)
+            if len(self.pending[key]) >= self.max_rows:
+                self.cond.notify_all()
+
+    def full(self):
+        return any(len(rows) >= self.max_rows for rows in self.pending.values())
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or self.full(), timeout=self.interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    def flush(self, worksheet_id=None, tab_name=None):
+        '''writes pending rows now, optionally only those for one spreadsheet or tab'''
+        with self.flush_lock:
+            with self.cond:
+                keys = [
+                    key for key in self.pending
+                    if worksheet_id in (None, key[0]) and tab_name in (None, key[1])
+                ]
+                batches = {key: self.pending.pop(key) for key in keys}
+                self.count -= sum(len(rows) for rows in batches.values())
+                self.cond.notify_all()
+            for (sheet_id, tab, range), rows in batches.items():
+                try:
+                    self.append(rows, tab_name=tab, worksheet_id=sheet_id, range=range)
+                except Exception as e:
+                    print(f'could not write {len(rows)} rows to {tab}:', e)
+                    # only a rate limited append is known not to have landed
+                    if is_retryable(e, idempotent=False):
+                        self.requeue((sheet_id, tab, range), rows)
+
+    def requeue(self, key, rows):
+        '''puts rows back ahead of those queued for key since, dropping the oldest past max_pending'''
+        with self.cond:
+            if self.closed:
+                # nothing is left to retry them at exit
+                print(f'dropped {len(rows)} rows for {key[1]}')
+                return
+            dropped = max(0, len(rows) - max(0, self.max_pending - self.count))
+            if dropped:
+                print(f'dropped {dropped} rows for {key[1]}, the queue is full')
+            rows = rows[dropped:]
+            if rows:
+                self.pending[key] = rows + self.pending.get(key, [])
+                self.count += len(rows)
+
+    def close(self):
+        '''stops the background writer and writes whatever is still pending'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.flush()